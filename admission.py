@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Contrôle d'admission des tours de /chat
+# - UserRateLimiter : nombre de messages par visiteur (seau à jetons par clé) ;
+# - RunAdmission : nombre de runs OpenAI simultanés, avec une file d'attente bornée ;
+# - ConversationTurns : un seul tour à la fois par conversation, les messages arrivés pendant
+#   un run sont regroupés dans le tour suivant.
+
+
+# Demande refusée faute de capacité ; retry_after est le délai conseillé en secondes
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Capacité atteinte, réessayer dans {retry_after}s")
+        self.retry_after = retry_after
+
+
+class UserRateLimiter:
+    def __init__(self, per_minute, burst, max_users=10000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets = OrderedDict()  # Clé visiteur -> (jetons, instant de mise à jour)
+        self.lock = threading.Lock()
+
+    # Consommer un jeton dans le seau de chaque clé (ex. adresse IP et utilisateur) ;
+    # renvoie 0 si le message est accepté par tous, sinon le plus long délai d'attente en secondes
+    def check(self, *keys):
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            buckets = {}
+            for key in keys:
+                tokens, updated = self.buckets.pop(key, (self.burst, now))
+                buckets[key] = min(self.burst, tokens + (now - updated) * self.rate)
+            retry_after = max(
+                (max(1, int((1 - tokens) / self.rate + 0.999)) for tokens in buckets.values() if tokens < 1),
+                default=0
+            )
+            for key, tokens in buckets.items():
+                self.buckets[key] = (tokens if retry_after else tokens - 1, now)
+            while len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+        return retry_after
+
+
+class RunAdmission:
+    def __init__(self, max_running, max_waiting, wait_timeout):
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.running = 0
+        self.waiting = 0
+        self.average_run = 5.0  # Durée moyenne d'un tour (moyenne glissante), pour estimer Retry-After
+        self.condition = threading.Condition()
+
+    def _retry_after(self):
+        return max(1, int(self.average_run * (self.waiting + 1) / self.max_running + 0.999))
+
+    # Occuper une place de run ; lève Overloaded si la file est pleine ou l'attente trop longue
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            if self.running >= self.max_running:
+                if self.waiting >= self.max_waiting:
+                    raise Overloaded(self._retry_after())
+                self.waiting += 1
+                try:
+                    deadline = time.monotonic() + self.wait_timeout
+                    while self.running >= self.max_running:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise Overloaded(self._retry_after())
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.average_run = 0.8 * self.average_run + 0.2 * (time.monotonic() - started)
+                self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {"running": self.running, "waiting": self.waiting, "max_running": self.max_running, "max_waiting": self.max_waiting}
+
+
+# Tour de conversation : messages du visiteur traités par un même run
+class Turn:
+    def __init__(self, message):
+        self.messages = [message]
+        self.done = threading.Event()
+        self.result = None  # Réponse du tour, partagée avec les requêtes regroupées
+
+
+class ConversationTurns:
+    def __init__(self):
+        self.active = {}  # ConversationID -> tour en cours
+        self.pending = {}  # ConversationID -> tour en attente, qui reçoit les nouveaux messages
+        self.lock = threading.Lock()
+
+    # Rattacher un message à un tour : "lead" (la requête mène le tour), "merged" (ajouté au tour
+    # en attente, mené par une autre requête) ou "duplicate" (message identique déjà en cours)
+    def join(self, conversation_id, message):
+        with self.lock:
+            active = self.active.get(conversation_id)
+            pending = self.pending.get(conversation_id)
+            for turn in (active, pending):
+                if turn is not None and message in turn.messages:
+                    return "duplicate", turn
+            if active is None:
+                turn = self.active[conversation_id] = Turn(message)
+                return "lead", turn
+            if pending is not None:
+                pending.messages.append(message)
+                return "merged", pending
+            turn = self.pending[conversation_id] = Turn(message)
+            return "lead", turn
+
+    # Attendre la fin du tour en cours ; ensuite turn.messages n'est plus modifié
+    def wait(self, conversation_id, turn):
+        while True:
+            with self.lock:
+                active = self.active.get(conversation_id)
+                if active is None or active is turn:
+                    self.active[conversation_id] = turn
+                    if self.pending.get(conversation_id) is turn:
+                        del self.pending[conversation_id]
+                    return
+            active.done.wait()
+
+    def finish(self, conversation_id, turn, result):
+        with self.lock:
+            turn.result = result
+            if self.active.get(conversation_id) is turn:
+                del self.active[conversation_id]
+            if self.pending.get(conversation_id) is turn:
+                del self.pending[conversation_id]
+        turn.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {"active": len(self.active), "pending": len(self.pending)}
@@ -0,0 +1,196 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+# Limites Airtable : 10 enregistrements par requête, 5 requêtes/s par base
+AIRTABLE_BATCH_SIZE = 10
+AIRTABLE_MIN_INTERVAL = 0.2
+
+
+# File d'écriture différée vers Airtable
+# Les créations et mises à jour sont regroupées et envoyées par batch_create / batch_update
+# depuis un thread d'arrière-plan, hors du chemin des requêtes utilisateur.
+# Une création peut recevoir une clé locale (ex. MessageID) : les mises à jour qui la visent
+# avant son envoi sont fusionnées dans la création, et après son envoi la clé est traduite en Record ID.
+
+class AirtableWriter:
+    def __init__(self, flush_interval=0.5, max_retries=5, backoff=1.0, resolved_size=10000):
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.resolved_size = resolved_size
+        self.queue = queue.Queue()
+        self.resolved = OrderedDict()  # Clé locale -> Record ID Airtable
+        self.resolved_lock = threading.Lock()
+        self.pending_creates = OrderedDict()  # Clé locale -> (table, champs)
+        self.pending_updates = OrderedDict()  # (table, référence) -> (table, référence, champs, champ clé)
+        self.last_call = 0.0
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="airtable-writer", daemon=True)
+        self.thread.start()
+
+    # Mettre en file la création d'un enregistrement
+
+    def create(self, table, fields, key=None):
+        self.queue.put(("create", table, key, fields, None))
+
+    # Mettre en file la mise à jour d'un enregistrement (Record ID ou clé locale)
+    # key_field permet de retrouver l'enregistrement par une clé métier si la référence est inconnue
+
+    def update(self, table, ref, fields, key_field=None):
+        self.queue.put(("update", table, ref, fields, key_field))
+
+    # Traduire une clé locale en Record ID Airtable une fois l'enregistrement créé
+
+    def resolve(self, key):
+        with self.resolved_lock:
+            return self.resolved.get(key)
+
+    # Attendre que toutes les écritures en file soient envoyées
+
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self.queue.put(("flush", None, None, None, done))
+        return done.wait(timeout)
+
+    # Vider la file puis arrêter le thread d'écriture (appelé à l'arrêt du processus)
+
+    def stop(self, timeout=30):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.flush(timeout)
+        logger.info("File d'écriture Airtable vidée avant l'arrêt.")
+
+    def _run(self):
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                op, table, ref, fields, extra = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush_pending()
+                deadline = None
+                continue
+
+            if op == "flush":
+                self._flush_pending()
+                deadline = None
+                extra.set()
+                continue
+
+            if op == "create":
+                self.pending_creates[ref if ref is not None else object()] = (table, dict(fields))
+            elif ref in self.pending_creates:
+                self.pending_creates[ref][1].update(fields)
+            else:
+                pending_key = (id(table), ref)
+                if pending_key in self.pending_updates:
+                    self.pending_updates[pending_key][2].update(fields)
+                else:
+                    self.pending_updates[pending_key] = (table, ref, dict(fields), extra)
+
+            if len(self.pending_creates) + len(self.pending_updates) >= AIRTABLE_BATCH_SIZE:
+                self._flush_pending()
+                deadline = None
+            elif deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+
+    def _flush_pending(self):
+        try:
+            self._flush_creates()
+            self._flush_updates()
+        except Exception as e:
+            logger.error(f"Erreur inattendue dans la file d'écriture Airtable : {e}")
+
+    def _flush_creates(self):
+        creates, self.pending_creates = self.pending_creates, OrderedDict()
+        by_table = OrderedDict()
+        for key, (table, fields) in creates.items():
+            by_table.setdefault(id(table), (table, []))[1].append((key, fields))
+
+        for table, items in by_table.values():
+            for start in range(0, len(items), AIRTABLE_BATCH_SIZE):
+                chunk = items[start:start + AIRTABLE_BATCH_SIZE]
+                records = self._send_batch(table.batch_create, [fields for _, fields in chunk])
+                if None in records:
+                    logger.error(f"{records.count(None)} création(s) abandonnée(s) dans la table {table.name}.")
+                with self.resolved_lock:
+                    for (key, _), record in zip(chunk, records):
+                        if record is not None and isinstance(key, str):
+                            self.resolved[key] = record["id"]
+                    while len(self.resolved) > self.resolved_size:
+                        self.resolved.popitem(last=False)
+
+    def _flush_updates(self):
+        updates, self.pending_updates = self.pending_updates, OrderedDict()
+        by_table = OrderedDict()
+        for table, ref, fields, key_field in updates.values():
+            record_id = self._resolve_ref(table, ref, key_field)
+            if not record_id:
+                logger.error(f"Mise à jour ignorée : enregistrement {ref} introuvable dans la table {table.name}.")
+                continue
+            by_table.setdefault(id(table), (table, []))[1].append({"id": record_id, "fields": fields})
+
+        for table, items in by_table.values():
+            for start in range(0, len(items), AIRTABLE_BATCH_SIZE):
+                records = self._send_batch(table.batch_update, items[start:start + AIRTABLE_BATCH_SIZE])
+                if None in records:
+                    logger.error(f"{records.count(None)} mise(s) à jour abandonnée(s) dans la table {table.name}.")
+
+    def _resolve_ref(self, table, ref, key_field):
+        record_id = self.resolve(ref)
+        if record_id:
+            return record_id
+        if ref.startswith("rec") or not key_field:
+            return ref
+        records = self._call(table.all, formula=f"{{{key_field}}} = '{ref}'", max_records=1)
+        return records[0]["id"] if records else None
+
+    # Envoi d'un lot : renvoie un résultat par enregistrement (None s'il est abandonné)
+    # Si Airtable refuse le lot (4xx hors 429, ex. champ inconnu ou valeur invalide), ses enregistrements
+    # sont renvoyés un par un pour n'abandonner que ceux qui sont refusés
+
+    def _send_batch(self, func, chunk):
+        try:
+            records = self._call(func, chunk, raise_client_errors=len(chunk) > 1)
+        except requests.HTTPError:
+            logger.warning(f"Lot de {len(chunk)} enregistrement(s) refusé par Airtable, envoi un par un.")
+            return [(self._call(func, [item]) or [None])[0] for item in chunk]
+        return records if records is not None else [None] * len(chunk)
+
+    # Appel Airtable avec limitation de débit et nouvelles tentatives (backoff exponentiel sur 429 / 5xx)
+    # raise_client_errors : lever l'erreur sur les autres 4xx au lieu de renvoyer None
+
+    def _call(self, func, *args, raise_client_errors=False, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            wait = AIRTABLE_MIN_INTERVAL - (time.monotonic() - self.last_call)
+            if wait > 0:
+                time.sleep(wait)
+            self.last_call = time.monotonic()
+            try:
+                with metrics.span(f"airtable.{func.__name__}"):
+                    return func(*args, **kwargs)
+            except requests.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if (status == 429 or (status and status >= 500)) and attempt < self.max_retries:
+                    delay = self.backoff * (2 ** attempt)
+                    logger.warning(f"Airtable a répondu {status}, nouvelle tentative dans {delay:.1f}s.")
+                    time.sleep(delay)
+                    continue
+                if raise_client_errors and status and 400 <= status < 500 and status != 429:
+                    raise
+                logger.error(f"Erreur Airtable ({status}) : {e}")
+                return None
+            except Exception as e:
+                logger.error(f"Erreur lors de l'écriture Airtable : {e}")
+                return None
+        return None
@@ -1,17 +1,41 @@
-from flask import Flask, request, jsonify
+import os
+
+# Serveur eventlet (par défaut) : les modules bloquants (socket, ssl, threading, time) sont remplacés
+# par leurs versions coopératives avant tout autre import, pour qu'un appel lent (run OpenAI,
+# Airtable, Slack) ne bloque plus les autres visiteurs
+if os.getenv("SOCKETIO_ASYNC_MODE", "eventlet") == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, request, jsonify, g, Response, has_request_context, copy_current_request_context
 from flask_cors import CORS
 import openai
 from openai import OpenAI
-import os
 import logging
 from pyairtable import Api
 from datetime import datetime, timezone
+import re
 import uuid
-import requests
+import random
 import hashlib
+import unicodedata
 import hmac
 import time
-from flask_socketio import SocketIO, emit
+import threading
+import atexit
+import signal
+import sys
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from airtable_writer import AirtableWriter
+from slack_dispatcher import SlackDispatcher
+from slack_events import SlackEventQueue
+from storage import AirtableStorage, SQLiteStorage
+from admission import Overloaded, UserRateLimiter, RunAdmission, ConversationTurns
+from retrieval import load_retriever
+from context_window import ContextWindow, ContextWindows, summarize_messages
+from metrics import registry as metrics
 
 # Initialiser Flask
 app = Flask(__name__)
@@ -20,12 +44,47 @@ app = Flask(__name__)
 CORS(app)
 
 # Configurer SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*")
+# SOCKETIO_MESSAGE_QUEUE (ex. redis://...) permet de diffuser les événements entre plusieurs dynos
+# SOCKETIO_ASYNC_MODE choisit le mode asynchrone (eventlet par défaut, threading pour le banc d'essai)
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    message_queue=os.getenv("SOCKETIO_MESSAGE_QUEUE"),
+    async_mode=os.getenv("SOCKETIO_ASYNC_MODE", "eventlet")
+)
 
 # Configurer les logs
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
+# Métriques : durées par étape et par endpoint, journal des requêtes lentes
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "3000"))  # 0 pour désactiver
+metrics.endpoint_resolver = lambda: (request.endpoint or "unknown") if has_request_context() else "background"
+
+def record_request_stage(stage, duration):
+    if has_request_context() and "stages" in g:
+        g.stages.append((stage, duration))
+
+metrics.span_listener = record_request_stage
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.stages = []
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_started" not in g:
+        return response
+    duration = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or "unknown"
+    metrics.observe("request_duration_seconds", duration, endpoint=endpoint)
+    metrics.inc("requests_total", endpoint=endpoint, status=response.status_code)
+    if SLOW_REQUEST_MS and duration * 1000 >= SLOW_REQUEST_MS:
+        stages = ", ".join(f"{stage}={d * 1000:.0f}ms" for stage, d in g.stages)
+        logger.warning(f"Requête lente {request.method} {request.path} : {duration * 1000:.0f} ms ({stages or 'aucune étape mesurée'})")
+    return response
+
 # Charger les clés API et secrets
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
@@ -43,14 +102,209 @@ if not all([OPENAI_API_KEY, AIRTABLE_API_KEY, BASE_ID, SLACK_BOT_TOKEN, SLACK_SI
 openai.api_key = OPENAI_API_KEY  # (reste toléré)
 client = OpenAI(api_key=OPENAI_API_KEY)
 ASSISTANT_ID = "asst_M2vXRRQZaRqHxyU17qJa9t0c"  # <-- Remplace par l'ID réel de ton agent (Playground)
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"  # Mode streaming par défaut de /chat
+
+# Index local des documents de files/ (construit par `python retrieval.py build`)
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))  # 0 pour désactiver
+retriever = load_retriever() if RETRIEVAL_TOP_K > 0 else None
+
+# Fenêtre de contexte : derniers messages tels quels dans un budget de tokens, les plus anciens résumés
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "20"))
+CONTEXT_SUMMARY_STEP = int(os.getenv("CONTEXT_SUMMARY_STEP", "6"))  # Messages sortis de la fenêtre avant mise à jour du résumé
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+
+# Durée de validité des conversations gardées en mémoire (index local, fenêtres de contexte), en secondes :
+# passé ce délai elles sont relues dans le stockage, pour voir le Mode et le thread OpenAI changés par
+# un autre dyno ou dans Airtable (0 = sans expiration)
+CONVERSATION_INDEX_TTL = float(os.getenv("CONVERSATION_INDEX_TTL", "30"))
+context_windows = ContextWindows(ttl=CONVERSATION_INDEX_TTL)
 
 # Airtable
-api = Api(AIRTABLE_API_KEY)
+api = Api(AIRTABLE_API_KEY, endpoint_url=os.getenv("AIRTABLE_ENDPOINT_URL", "https://api.airtable.com"))
 base = api.base(BASE_ID)
 airtable_context = base.table("Context")
 airtable_conversations = base.table("Conversations")
 airtable_messages = base.table("Messages")
 
+# File d'écriture différée : les créations de messages et mises à jour de conversations
+# sont envoyées par lots en arrière-plan, hors du temps de réponse
+airtable_writer = AirtableWriter(flush_interval=float(os.getenv("AIRTABLE_FLUSH_INTERVAL", "0.5")))
+atexit.register(airtable_writer.stop)
+
+# Stockage des conversations et des messages : Airtable seul (par défaut), ou base SQLite locale
+# recopiée dans Airtable (STORAGE_BACKEND=sqlite, à n'activer qu'avec un seul dyno web : la base d'un dyno
+# fait référence pour le Mode et les messages non lus, un autre dyno n'en verrait pas les modifications)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "airtable").lower()
+if STORAGE_BACKEND == "sqlite" and os.getenv("SOCKETIO_MESSAGE_QUEUE"):
+    raise ValueError("STORAGE_BACKEND=sqlite est réservé à un seul dyno : incompatible avec SOCKETIO_MESSAGE_QUEUE.")
+airtable_storage = AirtableStorage(airtable_conversations, airtable_messages, airtable_context, airtable_writer)
+if STORAGE_BACKEND == "sqlite":
+    storage = SQLiteStorage(os.getenv("STORAGE_PATH", "minotaure.db"), remote=airtable_storage)
+else:
+    storage = airtable_storage
+
+# Cache du contexte initial (table Context)
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "300"))  # Durée de validité en secondes
+CONTEXT_CACHE_RETRY = 30  # Délai avant un nouvel essai quand Airtable est en erreur
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # Jeton des endpoints /admin (désactivés si absent)
+SLACK_REFRESH_CONTEXT_COMMAND = "recharger contexte"
+
+# Index local des conversations
+CONVERSATION_INDEX_SIZE = int(os.getenv("CONVERSATION_INDEX_SIZE", "1000"))
+
+# Index LRU des conversations Airtable, interrogeable par ConversationID et par SlackThreadTS
+# Les écritures passent par update_conversation pour garder l'index à jour. Un enregistrement
+# est relu dans le stockage ttl secondes après sa dernière écriture locale ; l'attente couvre
+# l'envoi différé de ces écritures à Airtable.
+
+class ConversationIndex:
+    def __init__(self, max_size, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.records = OrderedDict()  # ConversationID -> enregistrement Airtable
+        self.updated = {}  # ConversationID -> instant de lecture ou de dernière écriture locale
+        self.by_thread_ts = {}  # SlackThreadTS -> ConversationID
+        self.by_record_id = {}  # Record ID Airtable -> ConversationID
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _copy(self, record):
+        return {"id": record["id"], "fields": dict(record["fields"])}
+
+    def put(self, record):
+        with self.lock:
+            conversation_id = record["fields"].get("ConversationID")
+            if not conversation_id:
+                return
+            self.records[conversation_id] = self._copy(record)
+            self.records.move_to_end(conversation_id)
+            self.updated[conversation_id] = time.monotonic()
+            self.by_record_id[record["id"]] = conversation_id
+            thread_ts = record["fields"].get("SlackThreadTS")
+            if thread_ts:
+                self.by_thread_ts[thread_ts] = conversation_id
+            while len(self.records) > self.max_size:
+                evicted_id, _ = next(iter(self.records.items()))
+                self._evict(evicted_id)
+
+    def _evict(self, conversation_id):
+        record = self.records.pop(conversation_id)
+        self.updated.pop(conversation_id, None)
+        self.by_record_id.pop(record["id"], None)
+        thread_ts = record["fields"].get("SlackThreadTS")
+        if self.by_thread_ts.get(thread_ts) == conversation_id:
+            del self.by_thread_ts[thread_ts]
+
+    # Enregistrement encore valide (verrou tenu) ; un enregistrement expiré est retiré et compte comme absent
+    def _lookup(self, conversation_id):
+        record = self.records.get(conversation_id) if conversation_id else None
+        if record is not None and self.ttl and time.monotonic() - self.updated[conversation_id] > self.ttl:
+            self._evict(conversation_id)
+            record = None
+        if record is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.records.move_to_end(conversation_id)
+        return self._copy(record)
+
+    def get(self, conversation_id):
+        with self.lock:
+            return self._lookup(conversation_id)
+
+    def get_by_thread_ts(self, thread_ts):
+        with self.lock:
+            return self._lookup(self.by_thread_ts.get(thread_ts))
+
+    def update_fields(self, record_id, fields):
+        with self.lock:
+            conversation_id = self.by_record_id.get(record_id)
+            record = self.records.get(conversation_id) if conversation_id else None
+            if record is None:
+                return
+            old_thread_ts = record["fields"].get("SlackThreadTS")
+            record["fields"].update(fields)
+            self.updated[conversation_id] = time.monotonic()
+            thread_ts = record["fields"].get("SlackThreadTS")
+            if thread_ts != old_thread_ts:
+                self.by_thread_ts.pop(old_thread_ts, None)
+                if thread_ts:
+                    self.by_thread_ts[thread_ts] = conversation_id
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.records),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+conversation_index = ConversationIndex(CONVERSATION_INDEX_SIZE, CONVERSATION_INDEX_TTL)
+metrics.gauge(
+    "conversation_index",
+    lambda: {(("stat", key),): value for key, value in conversation_index.stats().items()},
+    "Taille et compteurs de l'index local des conversations"
+)
+
+# Long-polling de /v2/messages
+MESSAGES_LONG_POLL_MAX = float(os.getenv("MESSAGES_LONG_POLL_MAX", "25"))  # Attente maximale en secondes
+MESSAGES_LONG_POLL_INTERVAL = 0.2
+
+# Tampon des derniers messages enregistrés par ce processus, par ConversationID
+# Permet de servir les messages encore en file d'écriture et de réveiller le long-polling
+
+class RecentMessages:
+    def __init__(self, per_conversation=50, max_conversations=1000):
+        self.per_conversation = per_conversation
+        self.max_conversations = max_conversations
+        self.messages = OrderedDict()  # ConversationID -> deque de messages
+        self.lock = threading.Lock()
+
+    def add(self, conversation_id, message):
+        with self.lock:
+            if conversation_id not in self.messages:
+                self.messages[conversation_id] = deque(maxlen=self.per_conversation)
+            self.messages[conversation_id].append(dict(message))
+            self.messages.move_to_end(conversation_id)
+            while len(self.messages) > self.max_conversations:
+                self.messages.popitem(last=False)
+
+    def find(self, conversation_id, message_id):
+        with self.lock:
+            for message in self.messages.get(conversation_id, ()):
+                if message["id"] == message_id:
+                    return dict(message)
+        return None
+
+    def unread_since(self, conversation_id, since=None):
+        with self.lock:
+            return [
+                dict(message) for message in self.messages.get(conversation_id, ())
+                if not message["displayed"] and (since is None or parse_timestamp(message["timestamp"]) > since)
+            ]
+
+    def mark_displayed(self, conversation_id, message_ids):
+        with self.lock:
+            for message in self.messages.get(conversation_id, ()):
+                if message["id"] in message_ids:
+                    message["displayed"] = True
+
+recent_messages = RecentMessages()
+
+# Slack : file d'envoi en arrière-plan avec connexions réutilisées
+SLACK_MERGE_TURN = os.getenv("SLACK_MERGE_TURN", "false").lower() == "true"  # Un seul message Slack par tour
+slack_dispatcher = SlackDispatcher(
+    {"bot": SLACK_BOT_TOKEN, "manual": SLACK_MANUAL_BOT_TOKEN},
+    url=f"{os.getenv('SLACK_API_URL', 'https://slack.com/api')}/chat.postMessage",
+    timeout=float(os.getenv("SLACK_TIMEOUT", "10"))
+)
+atexit.register(slack_dispatcher.stop)
+
 # Fonction pour vérifier les requêtes Slack
 
 def verify_slack_request(request):
@@ -72,89 +326,277 @@ def verify_slack_request(request):
 
 # Fonction pour notifier un nouvel événement de message via WebSocket
 
+# L'événement n'est envoyé qu'aux clients de la room de la conversation
+
 def notify_new_message(conversation_id, role, content, message_id):
     socketio.emit("new_message", {
         "conversation_id": conversation_id,
         "role": role,
         "content": content,
         "id": message_id  # Inclure l'ID du message
-    })
+    }, to=conversation_id)
 
-# Fonction pour envoyer un message sur Slack
+# Fonction pour diffuser un fragment de réponse de l'assistant via WebSocket
 
-def send_slack_message(text, channel, thread_ts=None, manual=False):
-    try:
-        slack_token = SLACK_MANUAL_BOT_TOKEN if manual else SLACK_BOT_TOKEN
-        if not slack_token:
-            raise ValueError("Token Slack non défini.")
-
-        url = "https://slack.com/api/chat.postMessage"
-        headers = {
-            "Authorization": f"Bearer {slack_token}",
-            "Content-Type": "application/json"
-        }
-        data = {
-            "channel": channel,
-            "text": text
-        }
-        if thread_ts:
-            data["thread_ts"] = thread_ts
+def notify_assistant_delta(conversation_id, delta):
+    socketio.emit("assistant_delta", {
+        "conversation_id": conversation_id,
+        "delta": delta
+    }, to=conversation_id)
+    socketio.sleep(0)  # Laisser partir l'événement sans attendre la fin du run
 
-        response = requests.post(url, headers=headers, json=data)
-        if response.status_code == 200 and response.json().get("ok"):
-            logger.info(f"Message Slack envoyé : {text}")
-            return response.json().get("ts")
-        else:
-            logger.error(f"Erreur lors de l'envoi du message Slack : {response.text}")
+# Fonction pour faire rejoindre au socket de l'appelant (socket_id envoyé à /chat) la room de sa conversation
+# Le navigateur ne connaît l'identifiant d'une nouvelle conversation qu'à la réponse de /chat : sans cela,
+# les événements du premier tour (fragments de la réponse, réponse servie depuis le cache) partiraient dans une room vide
+
+def join_caller_room(conversation_id, socket_id):
+    if not socket_id or not socketio.server.manager.is_connected(socket_id, "/"):
+        return
+    join_room(conversation_id, sid=socket_id, namespace="/")
+    socketio.emit("joined", {"conversation_id": conversation_id}, to=socket_id)
+
+# Fonction pour envoyer un message sur Slack
+# L'envoi se fait en arrière-plan ; on_posted(ts) est appelé une fois le message posté.
+# thread_key (ConversationID) permet de répondre dans un fil dont le thread_ts n'est pas encore connu.
+
+def send_slack_message(text, channel, thread_ts=None, manual=False, thread_key=None, on_posted=None):
+    slack_dispatcher.post(text, channel, thread_ts=thread_ts, thread_key=thread_key, manual=manual, on_posted=on_posted)
+
+# Fonction pour relayer un tour de conversation (visiteur + Minotaure) dans le fil Slack
+
+def send_slack_turn(conversation_id, thread_ts, user_message, assistant_message):
+    visitor_line = f":bust_in_silhouette: Visiteur : {user_message}"
+    minotaure_line = f":taurus: Minotaure : {assistant_message}"
+    if SLACK_MERGE_TURN:
+        send_slack_message(f"{visitor_line}\n{minotaure_line}", channel="#conversationsite", thread_ts=thread_ts, thread_key=conversation_id)
+    else:
+        send_slack_message(visitor_line, channel="#conversationsite", thread_ts=thread_ts, thread_key=conversation_id)
+        send_slack_message(minotaure_line, channel="#conversationsite", thread_ts=thread_ts, thread_key=conversation_id)
+
+# Fonction pour récupérer une conversation par ConversationID (stockage seulement si absente de l'index)
+
+def get_conversation(conversation_id):
+    record = conversation_index.get(conversation_id)
+    if record is None:
+        record = storage.get_conversation(conversation_id)
+        if not record:
             return None
-    except Exception as e:
-        logger.error(f"Erreur lors de l'envoi du message Slack : {e}")
+        conversation_index.put(record)
+    return record
+
+# Fonction pour récupérer une conversation par SlackThreadTS (stockage seulement si absente de l'index)
+
+def get_conversation_by_thread_ts(thread_ts):
+    if not thread_ts:
         return None
+    record = conversation_index.get_by_thread_ts(thread_ts)
+    if record is None:
+        record = storage.get_conversation_by_thread_ts(thread_ts)
+        if not record:
+            return None
+        conversation_index.put(record)
+    return record
 
-# Charger le contexte initial depuis Airtable
+# Fonction pour mettre à jour une conversation dans le stockage et dans l'index local
 
-def load_context_from_airtable():
+def update_conversation(record_id, fields):
+    storage.update_conversation(record_id, fields)
+    conversation_index.update_fields(record_id, fields)
+
+# Charger le contexte initial depuis Airtable (None en cas d'erreur)
+
+def fetch_context_from_airtable():
     try:
-        records = airtable_context.all(max_records=1, sort=["Timestamp"])
+        records = storage.load_context()
         if not records:
             logger.error("Aucun contexte trouvé dans Airtable.")
-            return []
+            return None
 
         first_record = records[0]["fields"]
         return [{"role": first_record["Role"], "content": first_record["Content"]}]
     except Exception as e:
         logger.error(f"Erreur lors du chargement du contexte depuis Airtable : {e}")
-        return []
+        return None
+
+# Cache du contexte initial, partagé par toutes les conversations du processus
+# Rechargé après CONTEXT_CACHE_TTL secondes ou sur demande (/admin/context/refresh, commande Slack) ;
+# si Airtable est en erreur, la dernière valeur valide continue d'être servie.
+
+class ContextCache:
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self.value = None
+        self.loaded_at = 0.0
+        self.expires_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def _fresh(self):
+        return self.value is not None and time.monotonic() < self.expires_at
+
+    def get(self):
+        if self._fresh():
+            self.hits += 1
+            return list(self.value)
+        with self.lock:
+            # Un seul rechargement à la fois : les requêtes en attente profitent du résultat
+            if self._fresh():
+                self.hits += 1
+                return list(self.value)
+            self.misses += 1
+            self._reload()
+            return list(self.value or [])
+
+    # Recharger immédiatement ; renvoie False si Airtable est en erreur (l'ancienne valeur est gardée)
+    def refresh(self):
+        with self.lock:
+            return self._reload()
+
+    def _reload(self):
+        value = self.loader()
+        if value is None:
+            self.errors += 1
+            if self.value is not None:
+                logger.warning("Contexte Airtable indisponible : dernière valeur valide conservée.")
+                # Nouvel essai après un délai court plutôt qu'à chaque requête
+                self.expires_at = time.monotonic() + min(self.ttl, CONTEXT_CACHE_RETRY)
+            return False
+        self.value = value
+        self.loaded_at = time.monotonic()
+        self.expires_at = self.loaded_at + self.ttl
+        return True
+
+    def stats(self):
+        return {
+            "loaded": self.value is not None,
+            "age_seconds": round(time.monotonic() - self.loaded_at, 1) if self.value is not None else None,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors
+        }
+
+context_cache = ContextCache(fetch_context_from_airtable, CONTEXT_CACHE_TTL)
+metrics.gauge(
+    "context_cache",
+    lambda: {(("stat", key),): int(value) for key, value in context_cache.stats().items() if value is not None},
+    "Compteurs du cache du contexte initial"
+)
+
+def load_context_from_airtable():
+    return context_cache.get()
+
+# Cache des réponses aux premiers messages (optionnel, OPENING_CACHE_SIZE > 0)
+# Clé : message normalisé + empreinte du contexte initial et de l'agent. Chaque entrée garde jusqu'à
+# OPENING_CACHE_VARIANTS réponses distinctes obtenues par de vrais runs ; une réponse n'est servie depuis
+# le cache qu'après ce nombre de runs, tirée au hasard pour ne pas répéter mot pour mot la même ouverture.
+
+OPENING_CACHE_SIZE = int(os.getenv("OPENING_CACHE_SIZE", "0"))  # 0 pour désactiver
+OPENING_CACHE_TTL = float(os.getenv("OPENING_CACHE_TTL", "86400"))
+OPENING_CACHE_VARIANTS = int(os.getenv("OPENING_CACHE_VARIANTS", "3"))
+OPENING_CACHE_MAX_CHARS = int(os.getenv("OPENING_CACHE_MAX_CHARS", "80"))  # Seuls les messages courts (salutations)
+
+class OpeningCache:
+    def __init__(self, max_size, ttl, variants, max_chars):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variants = variants
+        self.max_chars = max_chars
+        self.entries = OrderedDict()  # Clé -> (instant de création, nombre de runs, réponses distinctes)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Clé du cache, None si le message ne se prête pas au cache
+    def key(self, message, context):
+        if not self.max_size or len(message) > self.max_chars:
+            return None
+        text = unicodedata.normalize("NFKD", message.lower())
+        text = " ".join(re.findall(r"\w+", "".join(c for c in text if not unicodedata.combining(c))))
+        if not text:
+            return None
+        digest = hashlib.sha256(f"{ASSISTANT_ID}\n{context}".encode("utf-8")).hexdigest()[:16]
+        return f"{digest}:{text}"
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None or entry[1] < self.variants:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return random.choice(entry[2])
+
+    def add(self, key, response):
+        with self.lock:
+            created, runs, responses = self.entries.get(key, (time.monotonic(), 0, []))
+            if response not in responses and len(responses) < self.variants:
+                responses = responses + [response]
+            self.entries[key] = (created, runs + 1, responses)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+opening_cache = OpeningCache(OPENING_CACHE_SIZE, OPENING_CACHE_TTL, OPENING_CACHE_VARIANTS, OPENING_CACHE_MAX_CHARS)
+metrics.gauge(
+    "opening_cache",
+    lambda: {(("stat", key),): value for key, value in opening_cache.stats().items()},
+    "Taille et taux de succès du cache des premiers messages"
+)
 
 # Fonction pour créer une nouvelle conversation
 
-def create_conversation(user=None):
+def create_conversation(user=None, conversation_id=None):
     try:
-        conversation_id = str(uuid.uuid4())
+        conversation_id = conversation_id or str(uuid.uuid4())
         data = {
             "ConversationID": conversation_id,
             "User": user or "anonymous",
             "StartTimestamp": datetime.now().isoformat()
         }
-        record = airtable_conversations.create(data)
+        record = storage.create_conversation(data)
         record_id = record["id"]
+        conversation_index.put(record)
+
+        # Le fil Slack est créé en arrière-plan ; son thread_ts est enregistré dès qu'il est connu
+        def on_thread_started(thread_ts):
+            update_conversation(record_id, {"SlackThreadTS": thread_ts})
+            logger.info(f"Fil Slack {thread_ts} associé à la conversation {conversation_id}")
 
-        thread_ts = send_slack_message(
+        send_slack_message(
             ":taurus: Une conversation vient de démarrer sur le site du Minotaure.",
-            channel="#conversationsite"
+            channel="#conversationsite",
+            thread_key=conversation_id,
+            on_posted=on_thread_started
         )
-        if thread_ts:
-            airtable_conversations.update(record_id, {"SlackThreadTS": thread_ts})
 
-        logger.info(f"Nouvelle conversation créée avec Record ID : {record_id}, thread_ts : {thread_ts}")
-        return conversation_id, thread_ts
+        logger.info(f"Nouvelle conversation créée avec Record ID : {record_id}")
+        return conversation_id, None
     except Exception as e:
         logger.error(f"Erreur lors de la création de la conversation : {e}")
         return None, None
 
 # Fonction pour enregistrer un message
 
-def save_message(conversation_record_id, role, content, displayed=False):
+def save_message(conversation_record_id, role, content, displayed=False, conversation_id=None):
     try:
         message_id = str(uuid.uuid4())
         data = {
@@ -165,151 +607,509 @@ def save_message(conversation_record_id, role, content, displayed=False):
             "Timestamp": datetime.now().isoformat(),
             "Displayed": displayed  # Ajout explicite du statut Displayed
         }
-        record = airtable_messages.create(data)
-        
-        # Notifier le client WebSocket
-        notify_new_message(conversation_record_id, role, content, record["id"])
+        # L'écriture Airtable est différée : le MessageID local sert d'identifiant au client
+        storage.add_message(conversation_id, data)
+
+        if conversation_id:
+            recent_messages.add(conversation_id, {
+                "id": message_id,
+                "role": role,
+                "content": content,
+                "timestamp": data["Timestamp"],
+                "displayed": displayed
+            })
 
-        logger.info(f"Message enregistré avec succès : {data}")
+        # Notifier le client WebSocket
+        notify_new_message(conversation_id or conversation_record_id, role, content, message_id)
 
+        logger.info(f"Message {message_id} ({role}) mis en file pour enregistrement.")
+        return message_id
     except Exception as e:
         logger.error(f"Erreur lors de l'enregistrement du message : {e}")
 
+# Fonction pour charger l'historique des messages d'une conversation
+
+def load_history(conversation_id):
+    messages = storage.list_messages(conversation_id)
+    return [{"role": msg["fields"]["Role"], "content": msg["fields"]["Content"]} for msg in messages]
+
+# Fonction pour convertir un contexte en messages de thread OpenAI
+
+def build_thread_messages(context):
+    thread_messages = []
+    for m in context:
+        role = (m.get("role") or "").lower()
+        content = m.get("content") or ""
+        if role == "system":
+            continue  # les instructions sont désormais dans l'agent
+        role = "assistant" if role == "assistant" else "user"  # normalisation
+        if content.strip():
+            thread_messages.append({"role": role, "content": content})
+    return thread_messages
+
+# Fonction pour ajouter les messages du visiteur au thread persistant (None si le thread est expiré ou absent)
+
+def append_to_thread(thread_id, user_messages):
+    if not thread_id:
+        return None
+    try:
+        for user_message in user_messages:
+            with metrics.span("openai.append_message"):
+                client.beta.threads.messages.create(thread_id=thread_id, role="user", content=user_message)
+        return thread_id
+    except (openai.NotFoundError, openai.BadRequestError) as e:
+        logger.warning(f"Thread OpenAI {thread_id} inutilisable, reconstruction : {e}")
+        return None
+
+# Fonction pour mémoriser le thread OpenAI d'une conversation (index local + stockage)
+
+def store_thread_id(conversation_id, record_id, thread_id):
+    try:
+        update_conversation(record_id, {"OpenAIThreadID": thread_id})
+    except Exception as e:
+        logger.error(f"Erreur lors de l'enregistrement du thread OpenAI pour {conversation_id} : {e}")
+
+# Fonction pour extraire le texte d'un message assistant OpenAI
+
+def extract_message_text(message):
+    parts = []
+    for item in message.content:
+        if getattr(item, "type", None) == "text":
+            parts.append(item.text.value)
+    return "\n".join(parts).strip()
+
+# Fonction pour créer la fenêtre de contexte d'une conversation à partir de son historique
+
+def new_context_window(history, fields):
+    return ContextWindow.from_history(
+        history,
+        CONTEXT_TOKEN_BUDGET,
+        CONTEXT_MAX_MESSAGES,
+        CONTEXT_SUMMARY_STEP,
+        summary=fields.get("Summary", ""),
+        summarized=fields.get("SummarizedCount", 0)
+    )
+
+# Fonction pour préparer le thread OpenAI du tour : ajout du message au thread persistant,
+# ou création d'un nouveau thread avec les seuls messages de la fenêtre de contexte.
+# Le contexte initial (pending_context) n'est attendu que si le thread doit être créé.
+# Renvoie aussi rebuilt=True quand le thread est nouveau et doit être mémorisé sur la conversation.
+
+def prepare_thread(conversation_id, fields, thread_id, pending_context, user_messages):
+    thread_id = append_to_thread(thread_id, user_messages)
+    window = context_windows.get(conversation_id) if thread_id else None
+    rebuilt = not thread_id
+
+    if not thread_id:
+        # Tout l'historique, y compris sans thread mémorisé (conversation antérieure ou retour du bot
+        # après le mode manuel) ; rien à charger pour une nouvelle conversation (fields vide)
+        history = load_history(conversation_id) if fields else []
+        window = new_context_window(history, fields)
+        for user_message in user_messages:
+            window.add(user_message)
+        start = window.verbatim_start()
+        messages = pending_context.result() + history[start:] + [{"role": "user", "content": m} for m in user_messages]
+        with metrics.span("openai.create_thread"):
+            thread = client.beta.threads.create(messages=build_thread_messages(messages))
+        thread_id = thread.id
+        window.thread_offset = start
+    elif window is None:
+        # Fenêtre inconnue de ce processus (redémarrage) : la recalculer depuis l'historique
+        window = new_context_window(load_history(conversation_id), fields)
+        for user_message in user_messages:
+            window.add(user_message)
+    else:
+        for user_message in user_messages:
+            window.add(user_message)
+
+    context_windows.put(conversation_id, window)
+    return thread_id, window, rebuilt
+
+# Fonction pour intégrer au résumé glissant les messages sortis de la fenêtre (exécutée en arrière-plan)
+
+def refresh_summary(conversation_id, record_id, window):
+    try:
+        target = window.budget_start()
+        older = load_history(conversation_id)[window.summarized:target]
+        if older:
+            with metrics.span("openai.summarize"):
+                summary = summarize_messages(client, SUMMARY_MODEL, window.summary, older)
+            window.summary, window.summarized = summary, target
+            update_conversation(record_id, {"Summary": summary, "SummarizedCount": target})
+            logger.info(f"Résumé de la conversation {conversation_id} mis à jour ({target} messages couverts).")
+    except Exception as e:
+        logger.error(f"Erreur lors de la mise à jour du résumé de la conversation {conversation_id} : {e}")
+    finally:
+        window.summarizing = False
+
+# Fonction pour composer les instructions additionnelles du run (résumé et passages de référence)
+
+def build_additional_instructions(window, user_message):
+    parts = []
+    if window.summary and window.summarized:
+        parts.append(f"Résumé des échanges précédents avec ce visiteur :\n{window.summary}")
+    passages = retrieve_passages(user_message)
+    if passages:
+        parts.append(passages)
+    return "\n\n".join(parts) or None
+
+# Fonction pour retrouver les passages des documents locaux pertinents pour le message du visiteur
+
+def retrieve_passages(user_message):
+    if not retriever:
+        return None
+    try:
+        with metrics.span("retrieval.search"):
+            passages = retriever.search(user_message, RETRIEVAL_TOP_K)
+    except Exception as e:
+        logger.error(f"Erreur lors de la recherche dans l'index local : {e}")
+        return None
+    if not passages:
+        return None
+    lines = ["Extraits de référence (à utiliser seulement s'ils sont pertinents) :"]
+    for i, passage in enumerate(passages, 1):
+        lines.append(f"[{i}] {passage['source']}, p.{passage['page']} : {passage['text']}")
+    return "\n".join(lines)
+
+# Fonction pour exécuter l'agent sur le thread et renvoyer (réponse, run réussi)
+# Un run en échec ou sans réponse renvoie son statut entre parenthèses, affiché tel quel au visiteur.
+# En mode streaming, les fragments de texte sont envoyés au fil de l'eau via WebSocket
+
+def run_assistant(thread_id, conversation_id, stream=False, additional_instructions=None, last_messages=None):
+    run_options = {}
+    if last_messages:
+        run_options["truncation_strategy"] = {"type": "last_messages", "last_messages": last_messages}
+    if additional_instructions:
+        run_options["additional_instructions"] = additional_instructions
+
+    if stream:
+        with metrics.span("openai.run_stream"), client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=ASSISTANT_ID, **run_options) as run_stream:
+            for delta in run_stream.text_deltas:
+                notify_assistant_delta(conversation_id, delta)
+            run = run_stream.get_final_run()
+            messages = list(reversed(run_stream.get_final_messages()))  # Plus récent en premier
+    else:
+        with metrics.span("openai.run"):
+            run = client.beta.threads.runs.create_and_poll(
+                thread_id=thread_id,
+                assistant_id=ASSISTANT_ID,
+                **run_options
+            )
+        messages = []
+        if run.status == "completed":
+            with metrics.span("openai.list_messages"):
+                messages = client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, limit=10).data
+
+    if run.status != "completed":
+        return f"(run status: {run.status})", False
+
+    # Récupérer la réponse assistant la plus récente
+    for m in messages:
+        if m.role == "assistant":
+            text = extract_message_text(m)
+            if text:
+                return text, True
+    return "(Aucune réponse)", False
+
+# Contrôle d'admission de /chat : débit par visiteur, runs OpenAI simultanés et file d'attente bornée
+user_rate_limiter = UserRateLimiter(
+    per_minute=float(os.getenv("CHAT_USER_RATE_PER_MINUTE", "20")),  # 0 pour désactiver
+    burst=int(os.getenv("CHAT_USER_BURST", "5"))
+)
+run_admission = RunAdmission(
+    max_running=int(os.getenv("OPENAI_MAX_CONCURRENT_RUNS", "16")),
+    max_waiting=int(os.getenv("OPENAI_RUN_QUEUE_SIZE", "32")),
+    wait_timeout=float(os.getenv("OPENAI_RUN_QUEUE_TIMEOUT", "30"))
+)
+conversation_turns = ConversationTurns()
+metrics.gauge(
+    "chat_admission",
+    lambda: {
+        (("stat", key),): value
+        for key, value in dict(run_admission.stats(), **{f"turns_{k}": v for k, v in conversation_turns.stats().items()}).items()
+    },
+    "Runs OpenAI en cours et en attente, tours de conversation actifs"
+)
+
+# Exécution parallèle des étapes indépendantes de /chat (green threads sous eventlet)
+chat_io_pool = ThreadPoolExecutor(max_workers=int(os.getenv("CHAT_IO_WORKERS", "32")), thread_name_prefix="chat-io")
+
+# Fonction pour lancer une étape en parallèle, rattachée à la requête en cours (métriques, requêtes lentes)
+
+def submit_io(func, *args):
+    stages = g.get("stages")
+
+    @copy_current_request_context
+    def run():
+        if stages is not None:
+            g.stages = stages
+        return func(*args)
+
+    return chat_io_pool.submit(run)
+
+# Fonction pour construire une réponse 429 avec l'en-tête Retry-After
+
+def too_many_requests(message, retry_after):
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+# Fonction pour identifier le visiteur (limite de débit) : adresse IP du client, plus le champ user s'il est fourni
+# Le champ user est choisi par le client : il s'ajoute à l'adresse IP sans jamais la remplacer.
+# Le routeur Heroku ajoute l'adresse du client en dernier dans X-Forwarded-For ; les entrées
+# précédentes viennent du client et ne sont pas fiables.
+
+def visitor_keys(user_id):
+    forwarded = request.headers.get("X-Forwarded-For", "")
+    keys = [f"ip:{forwarded.split(',')[-1].strip() or request.remote_addr}"]
+    if user_id and user_id != "anonymous":
+        keys.append(f"user:{user_id}")
+    return keys
+
+# Fonction pour transférer les messages du visiteur à l'opérateur (mode manuel)
+
+def forward_to_operator(conversation_id, record, user_messages):
+    for user_message in user_messages:
+        save_message(record["id"], "user", user_message, displayed=True, conversation_id=conversation_id)
+        send_slack_message(
+            f":bust_in_silhouette: Visiteur : {user_message}",
+            channel="#conversationsite",
+            thread_ts=record["fields"].get("SlackThreadTS"),
+            thread_key=conversation_id
+        )
+
+# Fonction pour répondre au premier message depuis le cache : aucun thread OpenAI n'est créé,
+# il le sera au tour suivant avec l'historique ; enregistrement, notification et Slack sont inchangés
+
+def serve_cached_opening(conversation_id, user_id, user_message, assistant_message, stream):
+    created_id, _ = create_conversation(user_id, conversation_id)
+    if not created_id:
+        return {"error": "Impossible de créer une conversation"}, 500
+    record = get_conversation(conversation_id)
+
+    save_message(record["id"], "user", user_message, displayed=True, conversation_id=conversation_id)
+    if stream:
+        notify_assistant_delta(conversation_id, assistant_message)
+    save_message(record["id"], "assistant", assistant_message, conversation_id=conversation_id)
+    send_slack_turn(conversation_id, None, user_message, assistant_message)
+
+    logger.info(f"Premier message de la conversation {conversation_id} servi depuis le cache.")
+    return {"response": assistant_message, "conversation_id": conversation_id}, 200
+
+# Fonction pour mener un tour de conversation automatique : les messages du tour sont envoyés
+# au thread OpenAI et un seul run produit la réponse. Renvoie (corps JSON, statut HTTP).
+
+def run_turn(conversation_id, record, user_id, user_messages, stream, pending_context):
+    # Premier message d'une conversation : réponse servie depuis le cache si possible
+    opening_key = None
+    if record is None and len(user_messages) == 1:
+        opening_key = opening_cache.key(user_messages[0], pending_context.result())
+        cached = opening_cache.get(opening_key) if opening_key else None
+        if cached:
+            return serve_cached_opening(conversation_id, user_id, user_messages[0], cached, stream)
+
+    with run_admission.slot():
+        if record is None:
+            # Nouvelle conversation : sa création (stockage + fil Slack) avance pendant la création du thread OpenAI
+            pending_creation = submit_io(create_conversation, user_id, conversation_id)
+            fields, thread_id = {}, None
+        else:
+            pending_creation = None
+            fields = record["fields"]
+            thread_id = fields.get("OpenAIThreadID")
+
+        # Réutiliser le thread OpenAI de la conversation : seuls les nouveaux messages sont envoyés.
+        # L'historique n'est rechargé que si le thread doit être reconstruit.
+        thread_id, window, rebuilt = prepare_thread(conversation_id, fields, thread_id, pending_context, user_messages)
+
+        if pending_creation is not None:
+            if not pending_creation.result()[0]:
+                return {"error": "Impossible de créer une conversation"}, 500
+            record = get_conversation(conversation_id)
+
+        record_id = record["id"]
+        if rebuilt:
+            store_thread_id(conversation_id, record_id, thread_id)
+
+        for user_message in user_messages:
+            save_message(record_id, "user", user_message, displayed=True, conversation_id=conversation_id)
+
+        # Seuls les derniers messages du thread sont envoyés au modèle, les précédents sont résumés
+        assistant_message, completed = run_assistant(
+            thread_id,
+            conversation_id,
+            stream=stream,
+            additional_instructions=build_additional_instructions(window, "\n".join(user_messages)),
+            last_messages=window.keep_count()
+        )
+
+    save_message(record_id, "assistant", assistant_message, conversation_id=conversation_id)
+    if opening_key and completed:
+        opening_cache.add(opening_key, assistant_message)
+
+    window.add(assistant_message)
+    if window.needs_summary():
+        window.summarizing = True
+        threading.Thread(target=refresh_summary, args=(conversation_id, record_id, window), daemon=True).start()
+
+    send_slack_turn(conversation_id, record["fields"].get("SlackThreadTS"), "\n".join(user_messages), assistant_message)
+
+    return {"response": assistant_message, "conversation_id": conversation_id}, 200
+
 @app.route("/chat", methods=["POST"])
 def chat_with_minotaure():
     try:
         user_message = request.json.get("message", "")
         user_id = request.json.get("user", "anonymous")
         conversation_id = request.json.get("conversation_id")
+        socket_id = request.json.get("socket_id")
+        stream = request.json.get("stream", STREAM_RESPONSES)
+        if not isinstance(stream, bool):
+            stream = str(stream).lower() == "true"  # Comme STREAM_RESPONSES : "false" ou 0 ne l'activent pas
 
         if not user_message:
             return jsonify({"error": "Message non fourni"}), 400
 
-        if not conversation_id:
-            conversation_id, thread_ts = create_conversation(user=user_id)
-            if not conversation_id:
-                return jsonify({"error": "Impossible de créer une conversation"}), 500
-            context = load_context_from_airtable()
-            records = airtable_conversations.all(formula=f"{{ConversationID}} = '{conversation_id}'")
-            mode = "automatique"  # Initialiser le mode par défaut pour une nouvelle conversation
-        else:
-            records = airtable_conversations.all(formula=f"{{ConversationID}} = '{conversation_id}'")
-            if not records:
-                return jsonify({"error": "Conversation introuvable"}), 404
+        retry_after = user_rate_limiter.check(*visitor_keys(user_id))
+        if retry_after:
+            metrics.inc("chat_rejected_total", reason="user_rate_limit")
+            return too_many_requests("Trop de messages, merci de patienter", retry_after)
 
-            thread_ts = records[0]["fields"].get("SlackThreadTS")
-            mode = records[0]["fields"].get("Mode", "automatique").lower()
-            context = load_context_from_airtable()
-            messages = airtable_messages.all(formula=f"{{ConversationID}} = '{conversation_id}'", sort=["Timestamp"])
-            for msg in messages:
-                context.append({"role": msg["fields"]["Role"], "content": msg["fields"]["Content"]})
-
-        record_id = records[0].get("id")
-        save_message(record_id, "user", user_message, displayed=True)
-        context.append({"role": "user", "content": user_message})
-
-        # Vérifiez si le mode est manuel
-        if mode == "manuel":
-            send_slack_message(f":bust_in_silhouette: Visiteur : {user_message}", channel="#conversationsite", thread_ts=thread_ts)
-            return jsonify({"response": None, "conversation_id": conversation_id})  # Rien n'est renvoyé au client
-
-        # ===============================
-        # Remplacement minimal: Agent OpenAI (Assistants API)
-        # ===============================
-        # 1) Construire un thread éphémère avec l'historique existant
-        thread_messages = []
-        for m in context:
-            role = (m.get("role") or "").lower()
-            content = m.get("content") or ""
-            if role == "system":
-                continue  # les instructions sont désormais dans l'agent
-            role = "assistant" if role == "assistant" else "user"  # normalisation
-            if content.strip():
-                thread_messages.append({"role": role, "content": content})
-
-        thread = client.beta.threads.create(messages=thread_messages)
-
-        # 2) Lancer le run auprès de l'agent et attendre la complétion
-        run = client.beta.threads.runs.create_and_poll(
-            thread_id=thread.id,
-            assistant_id=ASSISTANT_ID,
-        )
+        # Le contexte initial est chargé en parallèle ; il n'est attendu que si un thread doit être créé
+        pending_context = submit_io(load_context_from_airtable)
 
-        # 3) Récupérer la réponse assistant la plus récente
-        assistant_message = "(Aucune réponse)"
-        if run.status == "completed":
-            msgs = client.beta.threads.messages.list(thread_id=thread.id, limit=10)
-            for m in msgs.data:
-                if m.role == "assistant":
-                    parts = []
-                    for item in m.content:
-                        if getattr(item, "type", None) == "text":
-                            parts.append(item.text.value)
-                    text = "\n".join(parts).strip()
-                    if text:
-                        assistant_message = text
-                        break
+        is_new = not conversation_id
+        if is_new:
+            conversation_id = str(uuid.uuid4())
+            join_caller_room(conversation_id, socket_id)
         else:
-            assistant_message = f"(run status: {run.status})"
-
-        # ===============================
-
-        context.append({"role": "assistant", "content": assistant_message})
-
-        save_message(record_id, "assistant", assistant_message)
-
-        send_slack_message(f":bust_in_silhouette: Visiteur : {user_message}", channel="#conversationsite", thread_ts=thread_ts)
-        send_slack_message(f":taurus: Minotaure : {assistant_message}", channel="#conversationsite", thread_ts=thread_ts)
-
-        return jsonify({"response": assistant_message, "conversation_id": conversation_id})
+            record = get_conversation(conversation_id)
+            if not record:
+                return jsonify({"error": "Conversation introuvable"}), 404
+            join_caller_room(conversation_id, socket_id)
+
+            # Mode manuel : le message est transmis à l'opérateur, rien n'est renvoyé au client
+            if record["fields"].get("Mode", "automatique").lower() == "manuel":
+                forward_to_operator(conversation_id, record, [user_message])
+                return jsonify({"response": None, "conversation_id": conversation_id})
+
+        # Un seul run à la fois par conversation : un message reçu pendant un run rejoint le tour suivant,
+        # un message identique à un message en cours (double envoi) est ignoré
+        role, turn = conversation_turns.join(conversation_id, user_message)
+        if role == "duplicate":
+            metrics.inc("chat_coalesced_total", kind="duplicate")
+            return jsonify({"response": None, "conversation_id": conversation_id, "duplicate": True})
+        if role == "merged":
+            # La réponse est renvoyée à la requête qui mène le tour ; celle-ci reçoit seulement son statut
+            metrics.inc("chat_coalesced_total", kind="merged")
+            turn.done.wait()
+            body, status = turn.result
+            if status == 200:
+                body = {"response": None, "conversation_id": conversation_id, "merged": True}
+            return jsonify(body), status
+
+        result = ({"error": "Erreur interne"}, 500)
+        try:
+            conversation_turns.wait(conversation_id, turn)
+            user_messages = list(turn.messages)
+
+            # Relire la conversation : le tour précédent a pu changer son thread OpenAI,
+            # ou l'opérateur la passer en mode manuel pendant l'attente
+            record = None if is_new else get_conversation(conversation_id)
+            if record and record["fields"].get("Mode", "automatique").lower() == "manuel":
+                forward_to_operator(conversation_id, record, user_messages)
+                result = ({"response": None, "conversation_id": conversation_id}, 200)
+            else:
+                result = run_turn(conversation_id, record, user_id, user_messages, stream, pending_context)
+        except Overloaded as e:
+            metrics.inc("chat_rejected_total", reason="overloaded")
+            result = ({"error": "Serveur occupé, merci de réessayer", "retry_after": e.retry_after}, 429)
+        except Exception as e:
+            logger.error(f"Erreur dans l'endpoint '/chat': {e}")
+            result = ({"error": str(e)}, 500)
+        finally:
+            conversation_turns.finish(conversation_id, turn, result)
+
+        body, status = result
+        if status == 429:
+            return too_many_requests(body["error"], body["retry_after"])
+        return jsonify(body), status
     except Exception as e:
         logger.error(f"Erreur dans l'endpoint '/chat': {e}")
         return jsonify({"error": str(e)}), 500
 
+# Fonction pour traiter un événement Slack (appelée en arrière-plan par slack_event_queue)
+
+def handle_slack_event(data):
+    event = data.get("event") or {}
+    if event.get("type") != "message" or event.get("bot_id"):
+        return
+
+    user_message = event.get("text") or ""
+    channel_id = event.get("channel")
+    thread_ts = event.get("thread_ts")
+
+    # Commande Slack : recharger le contexte initial depuis Airtable
+    if user_message.strip().lower() == SLACK_REFRESH_CONTEXT_COMMAND:
+        refreshed = context_cache.refresh()
+        logger.info(f"Rechargement du contexte demandé depuis Slack ({'ok' if refreshed else 'échec'}).")
+        send_slack_message(
+            ":arrows_counterclockwise: Contexte rechargé." if refreshed
+            else ":warning: Airtable indisponible, l'ancien contexte est conservé.",
+            channel=channel_id,
+            thread_ts=thread_ts
+        )
+        return
+
+    # Récupérer la conversation (index local, sinon Airtable)
+    record = get_conversation_by_thread_ts(thread_ts)
+    if not record:
+        return
+
+    record_id = record["id"]
+    conversation_id = record["fields"].get("ConversationID")
+    mode = record["fields"].get("Mode", "automatique").lower()
+
+    if user_message.lower() == "bot":
+        if mode != "automatique":
+            update_conversation(record_id, {"Mode": "automatique"})
+            logger.info(f"Mode mis à jour en 'automatique' pour la conversation {conversation_id}.")
+        return
+
+    # Passer automatiquement en mode manuel si un message est écrit dans Slack
+    # Le thread OpenAI est abandonné : il sera reconstruit avec l'historique au retour du bot
+    if mode != "manuel":
+        update_conversation(record_id, {"Mode": "manuel", "OpenAIThreadID": ""})
+        logger.info(f"Mode mis à jour en 'manuel' pour la conversation {conversation_id}.")
+
+    # Enregistrer le message dans Airtable (save_message notifie le client WebSocket)
+    save_message(record_id, "assistant", user_message, displayed=False, conversation_id=conversation_id)
+
+slack_event_queue = SlackEventQueue(
+    handle_slack_event,
+    seen_size=int(os.getenv("SLACK_EVENTS_SEEN_SIZE", "10000")),
+    seen_ttl=float(os.getenv("SLACK_EVENTS_SEEN_TTL", "3600"))
+)
+atexit.register(slack_event_queue.stop)
+metrics.gauge(
+    "slack_events",
+    lambda: {(("stat", "pending"),): slack_event_queue.pending_count(), (("stat", "duplicates"),): slack_event_queue.duplicates},
+    "Événements Slack en file et doublons ignorés"
+)
+
+# Slack exige une réponse en moins de 3 s : l'événement est acquitté tout de suite et traité en arrière-plan
+
 @app.route("/slack/events", methods=["POST"])
 def slack_events():
     if not verify_slack_request(request):
         logger.error("Requête Slack non valide.")
         return jsonify({"error": "Unauthorized"}), 401
 
-    try:
-        data = request.json
-
-        if "event" in data:
-            event = data["event"]
-
-            if event.get("type") == "message" and not event.get("bot_id"):
-                user_message = event.get("text")
-                channel_id = event.get("channel")
-                thread_ts = event.get("thread_ts")
-
-                # Récupérer la conversation depuis Airtable
-                records = airtable_conversations.all(formula=f"{{SlackThreadTS}} = '{thread_ts}'")
-                if records:
-                    record_id = records[0]["id"]
-                    conversation_id = records[0]["fields"].get("ConversationID")
-                    mode = records[0]["fields"].get("Mode", "automatique").lower()
-
-                    if user_message.lower() == "bot":
-                        airtable_conversations.update(record_id, {"Mode": "automatique"})
-                        logger.info(f"Mode mis à jour en 'automatique' pour la conversation {conversation_id}.")
-                        return jsonify({"status": "ok", "message": "Mode automatique activé."}), 200
-
-                    # Passer automatiquement en mode manuel si un message est écrit dans Slack
-                    if mode != "manuel":
-                        airtable_conversations.update(record_id, {"Mode": "manuel"})
-                        logger.info(f"Mode mis à jour en 'manuel' pour la conversation {conversation_id}.")
-
-                    # Notifier le client WebSocket du message utilisateur
-                    notify_new_message(conversation_id, "assistant", user_message, message_id=record_id)
-
-                    # Enregistrer le message dans Airtable
-                    save_message(record_id, "assistant", user_message, displayed=False)
-
-        return jsonify({"status": "ok"}), 200
-    except Exception as e:
-        logger.error(f"Erreur dans l'endpoint Slack events : {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    data = request.get_json(silent=True) or {}
+    if "event" in data:
+        slack_event_queue.submit(data, retry_num=request.headers.get("X-Slack-Retry-Num"))
+    return jsonify({"status": "ok"}), 200
 
 
 @app.route("/chat_closed", methods=["POST"])
@@ -320,11 +1120,11 @@ def chat_closed():
         message = data.get("message", "Chatbot fermé par l'utilisateur")
 
         # Récupérer le thread_ts depuis Airtable
-        records = airtable_conversations.all(formula=f"{{ConversationID}} = '{conversation_id}'")
-        if not records:
+        record = get_conversation(conversation_id)
+        if not record:
             return jsonify({"error": "Conversation introuvable"}), 404
 
-        thread_ts = records[0]["fields"].get("SlackThreadTS")
+        thread_ts = record["fields"].get("SlackThreadTS")
         if not thread_ts:
             return jsonify({"error": "Thread TS introuvable"}), 404
 
@@ -344,11 +1144,11 @@ def chat_reopened():
         message = data.get("message", "Chatbot rouvert par l'utilisateur")
 
         # Récupérer le thread_ts depuis Airtable
-        records = airtable_conversations.all(formula=f"{{ConversationID}} = '{conversation_id}'")
-        if not records:
+        record = get_conversation(conversation_id)
+        if not record:
             return jsonify({"error": "Conversation introuvable"}), 404
 
-        thread_ts = records[0]["fields"].get("SlackThreadTS")
+        thread_ts = record["fields"].get("SlackThreadTS")
         if not thread_ts:
             return jsonify({"error": "Thread TS introuvable"}), 404
 
@@ -360,29 +1160,98 @@ def chat_reopened():
         logger.error(f"Erreur lors de la notification de réouverture : {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
         
+# Fonction pour convertir un horodatage ISO en datetime comparable (sans fuseau)
+
+def parse_timestamp(value):
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+# Fonction pour formater un message Airtable pour le client
+
+def format_message(msg):
+    return {
+        "id": msg["fields"].get("MessageID", msg["id"]),  # MessageID, identique à celui envoyé par WebSocket
+        "role": msg["fields"]["Role"],
+        "content": msg["fields"]["Content"],
+        "timestamp": msg["fields"]["Timestamp"]
+    }
+
+# Fonction pour convertir un curseur (horodatage ou MessageID) en horodatage
+
+def resolve_cursor(conversation_id, since):
+    if not since:
+        return None
+    timestamp = parse_timestamp(since)
+    if timestamp:
+        return timestamp
+
+    message = recent_messages.find(conversation_id, since)
+    if message:
+        return parse_timestamp(message["timestamp"])
+    record = storage.find_message(since)
+    if record:
+        return parse_timestamp(record["fields"].get("Timestamp"))
+    return None
+
+# Fonction pour lister les messages non affichés postérieurs au curseur
+# Le stockage et le tampon local sont fusionnés : les messages encore en file d'écriture Airtable sont inclus
+
+def collect_unread(conversation_id, since, include_storage=True):
+    unread = {}
+    if include_storage:
+        for msg in storage.unread_messages(conversation_id):
+            message = format_message(msg)
+            timestamp = parse_timestamp(message["timestamp"])
+            if since is None or (timestamp and timestamp > since):
+                message["record_id"] = msg["id"]
+                unread[message["id"]] = message
+    for message in recent_messages.unread_since(conversation_id, since):
+        message.pop("displayed", None)
+        unread.setdefault(message["id"], message)
+    return sorted(unread.values(), key=lambda m: parse_timestamp(m["timestamp"]) or datetime.min)
+
+@app.route("/v2/messages/<conversation_id>", methods=["GET"])
+def get_messages_since(conversation_id):
+    try:
+        since = resolve_cursor(conversation_id, request.args.get("since"))
+        wait = min(float(request.args.get("wait", 0)), MESSAGES_LONG_POLL_MAX)
+
+        messages = collect_unread(conversation_id, since)
+
+        # Long-polling : attendre un nouveau message de ce processus ou l'expiration du délai
+        deadline = time.monotonic() + wait
+        while not messages and time.monotonic() < deadline:
+            socketio.sleep(MESSAGES_LONG_POLL_INTERVAL)
+            messages = collect_unread(conversation_id, since, include_storage=False)
+
+        # Marquer les messages comme affichés en une seule écriture groupée (batch_update)
+        storage.mark_displayed([message.pop("record_id", message["id"]) for message in messages])
+        recent_messages.mark_displayed(conversation_id, {m["id"] for m in messages})
+
+        cursor = messages[-1]["timestamp"] if messages else request.args.get("since")
+        return jsonify({"messages": messages, "cursor": cursor})
+    except Exception as e:
+        logger.error(f"Erreur lors de la récupération des messages (v2) : {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/messages/<conversation_id>", methods=["GET"])
 def get_messages(conversation_id):
     try:
-        time.sleep(0.1)  # Petite pause pour laisser Airtable mettre à jour les statuts
-        formula = f"AND({{ConversationID}} = '{conversation_id}', NOT({{Displayed}}))"
-        messages = airtable_messages.all(formula=formula, sort=["Timestamp"])
-
-        response = []
-        for msg in messages:
-            # Ajouter le message à la réponse
-            response.append({
-                "id": msg["id"],  # ID Airtable
-                "role": msg["fields"]["Role"],
-                "content": msg["fields"]["Content"],
-                "timestamp": msg["fields"]["Timestamp"]
-            })
+        messages = storage.unread_messages(conversation_id)
+
+        response = [format_message(msg) for msg in messages]
 
-            # Mettre à jour la colonne Displayed
+        # Mettre à jour la colonne Displayed avant de répondre : ce endpoint n'a pas de curseur,
+        # le prochain appel ne doit plus trouver ces messages parmi les non lus
+        if messages:
             try:
-                airtable_messages.update(msg["id"], {"Displayed": True})
-                logger.info(f"Message {msg['id']} marqué comme affiché.")
+                storage.mark_displayed([msg["id"] for msg in messages], sync=True)
+                recent_messages.mark_displayed(conversation_id, {m["id"] for m in response})
+                logger.info(f"{len(messages)} message(s) marqué(s) comme affiché(s).")
             except Exception as e:
-                logger.error(f"Erreur lors de la mise à jour de 'Displayed' pour le message {msg['id']}: {e}")
+                logger.error(f"Erreur lors de la mise à jour de 'Displayed' : {e}")
 
         # Retourner la liste des messages à afficher
         return jsonify({"messages": response})
@@ -393,8 +1262,8 @@ def get_messages(conversation_id):
 @app.route("/messages/<message_id>/displayed", methods=["POST"])
 def mark_message_as_displayed(message_id):
     try:
-        # Mettre à jour la colonne Displayed pour le message spécifié
-        airtable_messages.update(message_id, {"Displayed": True})
+        # Mettre à jour la colonne Displayed pour le message spécifié (MessageID ou Record ID Airtable)
+        storage.mark_displayed([message_id])
         logger.info(f"Message {message_id} marqué comme affiché.")
         return jsonify({"status": "success", "message": f"Message {message_id} marqué comme affiché."}), 200
     except Exception as e:
@@ -402,9 +1271,54 @@ def mark_message_as_displayed(message_id):
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+# Rooms Socket.IO : chaque client rejoint la room de sa conversation
+
+@socketio.on("join")
+def on_join(data):
+    conversation_id = (data or {}).get("conversation_id")
+    if not conversation_id:
+        emit("error", {"message": "conversation_id manquant"})
+        return
+    join_room(conversation_id)
+    logger.debug(f"Client {request.sid} a rejoint la conversation {conversation_id}")
+    emit("joined", {"conversation_id": conversation_id})
+
+@socketio.on("leave")
+def on_leave(data):
+    conversation_id = (data or {}).get("conversation_id")
+    if conversation_id:
+        leave_room(conversation_id)
+        logger.debug(f"Client {request.sid} a quitté la conversation {conversation_id}")
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    return jsonify({
+        "conversation_index": conversation_index.stats(),
+        "context_cache": context_cache.stats(),
+        "opening_cache": opening_cache.stats(),
+        "runs": run_admission.stats(),
+        "turns": conversation_turns.stats()
+    }), 200
+
+# Recharger le contexte initial sans attendre l'expiration du cache
+
+@app.route("/admin/context/refresh", methods=["POST"])
+def refresh_context():
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {ADMIN_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    if not context_cache.refresh():
+        return jsonify({"error": "Airtable indisponible, l'ancien contexte est conservé", "context_cache": context_cache.stats()}), 503
+    return jsonify({"status": "ok", "context_cache": context_cache.stats()}), 200
+
 @app.route("/", methods=["GET"])
 def health_check():
     return "OK", 200
 
 if __name__ == "__main__":
+    # Arrêt propre (SIGTERM Heroku) : atexit vide la file d'écriture Airtable
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     socketio.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
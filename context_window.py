@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Comptage des tokens : tiktoken si disponible, sinon estimation à ~4 caractères par token
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _encoding = None
+
+MESSAGE_OVERHEAD_TOKENS = 4  # Rôle et séparateurs de chaque message
+
+
+def count_tokens(text):
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    if _encoding is not None:
+        return len(_encoding.encode(text)) + MESSAGE_OVERHEAD_TOKENS
+    return len(text) // 4 + 1 + MESSAGE_OVERHEAD_TOKENS
+
+
+# Fenêtre de contexte d'une conversation
+# Les derniers messages sont gardés tels quels dans la limite d'un budget de tokens ;
+# les plus anciens sont couverts par un résumé glissant (Summary / SummarizedCount sur la conversation).
+# thread_offset est l'index du premier message présent dans le thread OpenAI.
+
+class ContextWindow:
+    def __init__(self, token_budget, max_messages, summary_step, summary="", summarized=0):
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.summary_step = summary_step
+        self.tokens = []  # Nombre de tokens de chaque message de la conversation, dans l'ordre
+        self.summary = summary or ""
+        self.summarized = summarized or 0  # Nombre de messages couverts par le résumé
+        self.thread_offset = 0
+        self.summarizing = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_history(cls, history, token_budget, max_messages, summary_step, summary="", summarized=0):
+        window = cls(token_budget, max_messages, summary_step, summary, min(summarized or 0, len(history)))
+        window.tokens = [count_tokens(m.get("content")) for m in history]
+        return window
+
+    def add(self, content):
+        with self.lock:
+            self.tokens.append(count_tokens(content))
+
+    def __len__(self):
+        return len(self.tokens)
+
+    # Premier message gardé dans le budget de tokens et de messages
+    def budget_start(self):
+        total, start = 0, len(self.tokens)
+        while start > 0 and len(self.tokens) - start < self.max_messages:
+            if total + self.tokens[start - 1] > self.token_budget and start < len(self.tokens):
+                break
+            total += self.tokens[start - 1]
+            start -= 1
+        return start
+
+    # Premier message envoyé tel quel : les messages non encore résumés sont gardés
+    # (au plus summary_step messages de plus que le budget) pour éviter un trou dans le contexte
+    def verbatim_start(self):
+        start = self.budget_start()
+        start = max(min(start, self.summarized), start - self.summary_step)
+        return max(start, self.thread_offset)
+
+    # Nombre de messages du thread à conserver pour le run (truncation_strategy last_messages)
+    def keep_count(self):
+        return len(self.tokens) - self.verbatim_start()
+
+    # Le résumé doit avancer quand assez de messages sont sortis de la fenêtre
+    def needs_summary(self):
+        return not self.summarizing and self.budget_start() - self.summarized >= self.summary_step
+
+
+# Fenêtres des conversations actives (LRU)
+# Une fenêtre non utilisée depuis ttl secondes est recalculée depuis l'historique (0 = sans expiration) :
+# un autre processus a pu mener des tours de la conversation entre-temps
+
+class ContextWindows:
+    def __init__(self, max_size=1000, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.windows = OrderedDict()  # ConversationID -> (fenêtre, instant de mise à jour)
+        self.lock = threading.Lock()
+
+    def get(self, conversation_id):
+        with self.lock:
+            window, updated = self.windows.get(conversation_id, (None, 0.0))
+            if window is None:
+                return None
+            if self.ttl and time.monotonic() - updated > self.ttl:
+                del self.windows[conversation_id]
+                return None
+            self.windows.move_to_end(conversation_id)
+            return window
+
+    def put(self, conversation_id, window):
+        with self.lock:
+            self.windows[conversation_id] = (window, time.monotonic())
+            self.windows.move_to_end(conversation_id)
+            while len(self.windows) > self.max_size:
+                self.windows.popitem(last=False)
+
+
+# Fonction pour intégrer de nouveaux messages au résumé glissant d'une conversation
+
+def summarize_messages(client, model, previous_summary, messages, max_tokens=400):
+    transcript = "\n".join(f"{m['role']} : {m['content']}" for m in messages if m.get("content"))
+    response = client.chat.completions.create(
+        model=model,
+        temperature=0,
+        max_tokens=max_tokens,
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "Tu tiens à jour le résumé d'une conversation entre un visiteur et le Minotaure. "
+                    "Intègre les nouveaux échanges au résumé existant. Garde les faits, préférences, "
+                    "demandes et engagements utiles pour la suite, en français, en quelques phrases."
+                )
+            },
+            {
+                "role": "user",
+                "content": f"Résumé existant :\n{previous_summary or '(aucun)'}\n\nNouveaux échanges :\n{transcript}"
+            }
+        ]
+    )
+    return response.choices[0].message.content.strip()
@@ -1,5 +1,13 @@
 import os
+import argparse
 from enrich_prompt import process_conversations
 
 if __name__ == "__main__":
-    process_conversations()
+    parser = argparse.ArgumentParser(description="Enrichissement des conversations (score et thèmes)")
+    parser.add_argument("--full", action="store_true", help="Recalculer toutes les conversations, sans cache")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("ENRICH_WORKERS", "4")), help="Nombre de conversations traitées en parallèle")
+    parser.add_argument("--openai-rps", type=float, default=float(os.getenv("ENRICH_OPENAI_RPS", "5")), help="Requêtes OpenAI par seconde (0 = sans limite)")
+    parser.add_argument("--airtable-rps", type=float, default=float(os.getenv("ENRICH_AIRTABLE_RPS", "5")), help="Requêtes Airtable par seconde (0 = sans limite)")
+    args = parser.parse_args()
+
+    process_conversations(full=args.full, workers=args.workers, openai_rps=args.openai_rps, airtable_rps=args.airtable_rps)
@@ -1,8 +1,14 @@
 import os
 from pyairtable import Api
 from collections import Counter
-import openai
+import json
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from openai import OpenAI
 from datetime import datetime
+from metrics import registry as metrics
 
 # Charger les clés API depuis les variables d'environnement
 AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY")
@@ -18,58 +24,208 @@ base = api.base(BASE_ID)
 conversations_table = base.table("Conversations")
 messages_table = base.table("Messages")
 
+# Seuls les champs utiles au calcul du score sont chargés
+MESSAGE_FIELDS = ["ConversationID", "Content", "Timestamp"]
+CONVERSATION_FIELDS = ["ConversationID", "LastUpdated", "Themes", "SentimentScore"]
+SCORE_BATCH_SIZE = 100  # Mises à jour regroupées avant envoi (batch_update les découpe par 10)
+
 # Configurer OpenAI
-openai.api_key = OPENAI_API_KEY
+client = OpenAI(api_key=OPENAI_API_KEY)
+ENRICH_MODEL = os.getenv("ENRICH_MODEL", "gpt-4o-mini")
+
+# Taille des lots envoyés au modèle pour les longues conversations
+ENRICH_CHUNK_MESSAGES = int(os.getenv("ENRICH_CHUNK_MESSAGES", "40"))
+ENRICH_CHUNK_CHARS = int(os.getenv("ENRICH_CHUNK_CHARS", "12000"))
+
+SENTIMENTS = ("Positif", "Négatif", "Neutre")
+
+# Export des métriques de l'exécution au format Prometheus (ex. pour un collecteur textfile)
+ENRICH_METRICS_PATH = os.getenv("ENRICH_METRICS_PATH")
+
+# Fichier de reprise : ConversationID déjà traitées par une exécution interrompue
+# Au-delà de ENRICH_CHECKPOINT_MAX_AGE secondes après le début de cette exécution, il est ignoré
+ENRICH_CHECKPOINT_PATH = os.getenv("ENRICH_CHECKPOINT_PATH", ".enrich_checkpoint")
+ENRICH_CHECKPOINT_MAX_AGE = float(os.getenv("ENRICH_CHECKPOINT_MAX_AGE", "86400"))
+
+# Limiteur de débit (seau à jetons) partagé entre les workers ; rate=0 désactive la limite
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                attente = (1 - self.tokens) / self.rate
+            time.sleep(attente)
+
+# Durées et volumes par étape (chargement, analyse, écriture) pour le bilan de fin d'exécution
+class StatistiquesEtapes:
+    def __init__(self):
+        self.debut = time.monotonic()
+        self.etapes = {}  # étape -> [nombre, durée cumulée]
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def mesurer(self, etape, nombre=1):
+        debut = time.monotonic()
+        try:
+            with metrics.span(f"enrich.{etape}"):
+                yield
+        finally:
+            duree = time.monotonic() - debut
+            with self.lock:
+                totaux = self.etapes.setdefault(etape, [0, 0.0])
+                totaux[0] += nombre
+                totaux[1] += duree
 
-# Fonction pour analyser les sentiments d'un message
-def analyser_sentiment(message):
+    def afficher(self):
+        ecoule = time.monotonic() - self.debut
+        print(f"Bilan de l'enrichissement ({ecoule:.1f}s) :")
+        for etape, (nombre, duree) in self.etapes.items():
+            debit = nombre / ecoule if ecoule else 0.0
+            moyenne = duree / nombre if nombre else 0.0
+            print(f"  {etape:<12} {nombre:>6} opérations, {duree:8.1f}s cumulées, {moyenne * 1000:8.1f} ms/op, {debit:7.2f} op/s")
+
+openai_limiter = TokenBucket(0)
+airtable_limiter = TokenBucket(0)
+statistiques = StatistiquesEtapes()
+
+# Fonction pour convertir un horodatage ISO en datetime comparable (sans fuseau)
+def parse_timestamp(value):
     try:
-        response = openai.Completion.create(
-            model="text-davinci-003",
-            prompt=f"Analyse le sentiment de ce texte : '{message}'. Réponds par un seul mot : Positif, Négatif, ou Neutre.",
-            temperature=0,
-            max_tokens=10
-        )
-        sentiment = response["choices"][0]["text"].strip()
-        return sentiment
-    except Exception as e:
-        print(f"Erreur lors de l'analyse des sentiments : {e}")
-        return "Neutre"  # Retour par défaut en cas d'erreur
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+# Fonction pour découper les messages d'une conversation en lots pour l'analyse
+def decouper_messages(contents):
+    lot, taille = [], 0
+    for content in contents:
+        if lot and (len(lot) >= ENRICH_CHUNK_MESSAGES or taille + len(content) > ENRICH_CHUNK_CHARS):
+            yield lot
+            lot, taille = [], 0
+        lot.append(content)
+        taille += len(content)
+    if lot:
+        yield lot
 
-# Fonction pour extraire les thèmes principaux d'une conversation
-def extraire_themes(conversation):
+# Fonction pour analyser un lot de messages : sentiment de chaque message et thèmes, en un seul appel
+# Renvoie None si l'analyse a échoué (erreur d'appel ou réponse incomplète)
+def analyser_lot(contents):
+    messages_numerotes = "\n".join(f"{i}. {content}" for i, content in enumerate(contents, 1))
     try:
-        messages_concat = " ".join([msg["fields"]["Content"] for msg in conversation])
-        response = openai.Completion.create(
-            model="text-davinci-003",
-            prompt=f"Quels sont les thèmes principaux de ce texte ? {messages_concat}",
-            temperature=0,
-            max_tokens=50
-        )
-        themes = response["choices"][0]["text"].strip().split(", ")
-        return themes
+        openai_limiter.acquire()
+        with statistiques.mesurer("openai"):
+            response = client.chat.completions.create(
+                model=ENRICH_MODEL,
+                temperature=0,
+                response_format={"type": "json_object"},
+                messages=[
+                    {
+                        "role": "system",
+                        "content": (
+                            "Tu analyses des messages de conversation. Réponds uniquement en JSON de la forme "
+                            '{"sentiments": ["Positif" | "Négatif" | "Neutre", ...], "themes": ["...", ...]}. '
+                            "La liste sentiments contient exactement un élément par message, dans l'ordre. "
+                            "La liste themes contient les thèmes principaux de l'ensemble des messages."
+                        )
+                    },
+                    {"role": "user", "content": f"Nombre de messages : {len(contents)}\n{messages_numerotes}"}
+                ]
+            )
+        data = json.loads(response.choices[0].message.content)
     except Exception as e:
-        print(f"Erreur lors de l'extraction des thèmes : {e}")
-        return []  # Retour par défaut en cas d'erreur
+        print(f"Erreur lors de l'analyse d'un lot de {len(contents)} messages : {e}")
+        return None
+
+    sentiments = data.get("sentiments")
+    if not isinstance(sentiments, list) or len(sentiments) != len(contents):
+        print(f"Réponse incomplète pour un lot de {len(contents)} messages : {len(sentiments or [])} sentiment(s) reçu(s).")
+        return None
+    sentiments = [s if s in SENTIMENTS else "Neutre" for s in sentiments]
+    themes = data.get("themes", [])
+    if not isinstance(themes, list):
+        print(f"Réponse invalide pour un lot de {len(contents)} messages : themes n'est pas une liste.")
+        return None
+    themes = [str(theme).strip() for theme in themes if str(theme).strip()]
+    return sentiments, themes
+
+# Fonction pour analyser une conversation : un appel au modèle par lot de messages
+# Renvoie le solde des sentiments (Positif - Négatif) et les thèmes, ou None si un lot n'a pas pu être analysé.
+# precedent = (LastUpdated, thèmes, SentimentScore) du dernier enrichissement : seuls les messages plus
+# récents que LastUpdated sont envoyés au modèle, leurs sentiments et thèmes s'ajoutent à ceux enregistrés
+# dans Airtable. Sans precedent (--full ou conversation jamais enrichie), tous les messages sont analysés.
+def analyser_conversation(messages, precedent=None):
+    nouveaux, themes, score_sentiments = messages, [], 0
+    if precedent is not None:
+        last_updated, themes_existants, score_existant = precedent
+        nouveaux = []
+        for msg in messages:
+            timestamp = parse_timestamp(msg["fields"].get("Timestamp"))
+            if timestamp is None or timestamp > last_updated:
+                nouveaux.append(msg)
+        if len(nouveaux) < len(messages):
+            themes, score_sentiments = list(themes_existants), score_existant
+
+    contents = [msg["fields"].get("Content", "") for msg in nouveaux]
+    sentiments = {}
+    for lot in decouper_messages(list(dict.fromkeys(contents))):
+        resultat = analyser_lot(lot)
+        if resultat is None:
+            return None
+        lot_sentiments, lot_themes = resultat
+        sentiments.update(zip(lot, lot_sentiments))
+        themes.extend(theme for theme in lot_themes if theme not in themes)
 
-# Fonction pour calculer le score d'une conversation
-def calculer_score(conversation_id):
+    for content in contents:
+        score_sentiments += {"Positif": 1, "Négatif": -1}.get(sentiments[content], 0)
+    return score_sentiments, themes
+
+# Fonction pour trouver l'horodatage du message le plus récent d'une conversation
+def dernier_message(messages):
+    timestamps = [parse_timestamp(msg["fields"].get("Timestamp")) for msg in messages]
+    timestamps = [t for t in timestamps if t]
+    return max(timestamps) if timestamps else None
+
+# Fonction pour savoir si une conversation a reçu des messages depuis son dernier enrichissement
+def a_change(conversation, messages):
+    last_updated = parse_timestamp(conversation["fields"].get("LastUpdated"))
+    if last_updated is None:
+        return True
+    dernier = dernier_message(messages)
+    return dernier is not None and dernier > last_updated
+
+# Fonction pour calculer le score d'une conversation : (score, thèmes, solde des sentiments),
+# ou None en cas d'échec, pour la retraiter à l'exécution suivante
+def calculer_score(conversation_id, messages=None, precedent=None):
     try:
         # Charger les messages associés à la conversation
-        messages = messages_table.all(formula=f"{{ConversationID}} = '{conversation_id}'")
+        if messages is None:
+            messages = messages_table.all(formula=f"{{ConversationID}} = '{conversation_id}'")
         if not messages:
             print(f"Aucun message trouvé pour la conversation {conversation_id}.")
-            return 0, []
+            return 0, [], 0
 
         # Calcul du nombre de messages
         nombre_messages = len(messages)
 
-        # Analyse des sentiments
-        sentiments = [analyser_sentiment(msg["fields"]["Content"]) for msg in messages]
-        score_sentiments = sentiments.count("Positif") - sentiments.count("Négatif")
-
-        # Extraction des thèmes
-        themes = extraire_themes(messages)
+        # Analyse des sentiments et extraction des thèmes en un appel par lot de messages
+        analyse = analyser_conversation(messages, precedent)
+        if analyse is None:
+            return None
+        score_sentiments, themes = analyse
 
         # Calcul du score global
         score_messages = min(10, nombre_messages / 5)  # Max 10 points pour 50 messages
@@ -80,39 +236,184 @@ def calculer_score(conversation_id):
             (score_themes * 0.3)
         )
 
-        return round(total_score, 2), themes
+        return round(total_score, 2), themes, score_sentiments
     except Exception as e:
         print(f"Erreur lors du calcul du score : {e}")
-        return 0, []
+        return None
+
+# Fonction pour charger tous les messages en une seule passe, regroupés par conversation
+# Messages.ConversationID est un lien : la clé de regroupement est le Record ID de la conversation
+def charger_messages_par_conversation():
+    groupes = {}
+    pages = messages_table.iterate(fields=MESSAGE_FIELDS, sort=["Timestamp"])
+    while True:
+        airtable_limiter.acquire()
+        with statistiques.mesurer("airtable"):
+            page = next(pages, None)
+        if page is None:
+            break
+        for msg in page:
+            for conversation_record_id in msg["fields"].get("ConversationID", []):
+                groupes.setdefault(conversation_record_id, []).append(msg)
+    return groupes
 
-# Fonction pour mettre à jour Airtable avec les scores et thèmes
-def enregistrer_score(conversation_id, score, themes):
+# Fonction pour préparer la mise à jour Airtable d'une conversation
+# LastUpdated est l'horodatage du dernier message scoré (et non l'heure d'écriture) : un message
+# arrivé après le chargement des messages reste plus récent et sera scoré à l'exécution suivante
+# SentimentScore garde le solde des sentiments des messages scorés, complété aux exécutions suivantes
+def preparer_score(record_id, score, themes, score_sentiments, last_updated):
+    return {
+        "id": record_id,
+        "fields": {
+            "Score": score,
+            "Themes": ", ".join(themes),
+            "SentimentScore": score_sentiments,
+            "LastUpdated": last_updated.isoformat()
+        }
+    }
+
+# Fonction pour mettre à jour Airtable avec les scores et thèmes (par lots de 10)
+def enregistrer_scores(mises_a_jour):
+    if not mises_a_jour:
+        return True
     try:
-        records = conversations_table.all(formula=f"{{ConversationID}} = '{conversation_id}'")
-        if records:
-            record_id = records[0]["id"]
-            conversations_table.update(record_id, {
-                "Score": score,
-                "Themes": ", ".join(themes),
-                "LastUpdated": datetime.now().isoformat()
-            })
-            print(f"Conversation {conversation_id} mise à jour avec un score de {score} et les thèmes {themes}.")
+        for debut in range(0, len(mises_a_jour), 10):
+            lot = mises_a_jour[debut:debut + 10]
+            airtable_limiter.acquire()
+            with statistiques.mesurer("airtable"):
+                conversations_table.batch_update(lot)
+        print(f"{len(mises_a_jour)} conversation(s) mise(s) à jour dans Airtable.")
+        return True
     except Exception as e:
         print(f"Erreur lors de la mise à jour d'Airtable : {e}")
+        return False
+
+# Fonctions de reprise : la première ligne du fichier décrit l'exécution (début et mode),
+# les suivantes sont les ConversationID traitées. Un fichier d'un autre mode, trop ancien
+# ou sans en-tête est ignoré : renvoie alors (None, ensemble vide).
+def charger_checkpoint(full, path=ENRICH_CHECKPOINT_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            lignes = [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return None, set()
+    try:
+        entete = json.loads(lignes[0]) if lignes else {}
+        debut = parse_timestamp(entete.get("debut"))
+    except (ValueError, AttributeError):
+        entete, debut = {}, None
+    if debut is None or entete.get("full") != full or (datetime.now() - debut).total_seconds() > ENRICH_CHECKPOINT_MAX_AGE:
+        print("Fichier de reprise ignoré : exécution trop ancienne, d'un autre mode ou sans en-tête.")
+        return None, set()
+    return debut, set(lignes[1:])
 
-# Fonction principale pour traiter toutes les conversations
-def process_conversations():
+def creer_checkpoint(debut, full, path=ENRICH_CHECKPOINT_PATH):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"debut": debut.isoformat(), "full": full}) + "\n")
+
+def ajouter_checkpoint(conversation_ids, path=ENRICH_CHECKPOINT_PATH):
+    with open(path, "a", encoding="utf-8") as f:
+        for conversation_id in conversation_ids:
+            f.write(f"{conversation_id}\n")
+
+# Fonction exécutée par un worker : score d'une conversation (mise à jour None en cas d'échec)
+# instantane : heure du chargement des messages, retenue comme LastUpdated d'une conversation sans message
+def traiter_conversation(conversation, messages, full, instantane):
+    fields = conversation["fields"]
+    conversation_id = fields.get("ConversationID")
+    print(f"Traitement de la conversation {conversation_id}...")
+    # Reprise du dernier enrichissement, sauf en mode complet ou s'il n'a pas enregistré de SentimentScore
+    last_updated = parse_timestamp(fields.get("LastUpdated"))
+    precedent = None
+    if not full and last_updated is not None and fields.get("SentimentScore") is not None:
+        precedent = (last_updated, [t for t in fields.get("Themes", "").split(", ") if t], fields["SentimentScore"])
+    with statistiques.mesurer("score"):
+        resultat = calculer_score(conversation_id, messages, precedent)
+    if resultat is None:
+        return conversation_id, None
+    score, themes, score_sentiments = resultat
+    return conversation_id, preparer_score(conversation["id"], score, themes, score_sentiments, dernier_message(messages) or instantane)
+
+# Fonction principale pour traiter les conversations
+# Par défaut, seules les conversations ayant de nouveaux messages depuis LastUpdated sont rescorées ;
+# les messages plus anciens ne sont pas renvoyés au modèle (solde des sentiments et thèmes repris
+# d'Airtable). full=True force le recalcul complet de toutes les conversations.
+# Les conversations sont scorées par `workers` threads, avec des débits OpenAI et Airtable limités
+# (requêtes/s, 0 = sans limite). Les ConversationID enregistrées sont notées dans le fichier de reprise,
+# qui est supprimé à la fin d'une exécution complète. À la reprise, une conversation déjà notée n'est
+# ignorée que si elle n'a pas reçu de message depuis le début de l'exécution interrompue.
+def process_conversations(full=False, workers=1, openai_rps=0, airtable_rps=5):
+    global openai_limiter, airtable_limiter, statistiques
+    openai_limiter = TokenBucket(openai_rps)
+    airtable_limiter = TokenBucket(airtable_rps)
+    statistiques = StatistiquesEtapes()
+
+    debut_reprise, deja_traitees = charger_checkpoint(full)
+    if debut_reprise is None:
+        creer_checkpoint(datetime.now(), full)
+    elif deja_traitees:
+        print(f"Reprise de l'exécution du {debut_reprise.isoformat()} : {len(deja_traitees)} conversation(s) déjà traitée(s).")
+    traitees, ignorees, echecs = 0, 0, 0
+    mises_a_jour, ids_en_attente = [], []
     try:
-        conversations = conversations_table.all()
+        airtable_limiter.acquire()
+        with statistiques.mesurer("airtable"):
+            conversations = conversations_table.all(fields=CONVERSATION_FIELDS)
         if not conversations:
             print("Aucune conversation trouvée.")
             return
 
-        for conversation in conversations:
-            conversation_id = conversation["fields"]["ConversationID"]
-            print(f"Traitement de la conversation {conversation_id}...")
-            score, themes = calculer_score(conversation_id)
-            enregistrer_score(conversation_id, score, themes)
+        instantane = datetime.now()
+        messages_par_conversation = charger_messages_par_conversation()
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = []
+            for conversation in conversations:
+                messages = messages_par_conversation.get(conversation["id"], [])
+                reprise = (
+                    conversation["fields"].get("ConversationID") in deja_traitees
+                    and (dernier_message(messages) or datetime.min) <= debut_reprise
+                )
+                if reprise or (not full and not a_change(conversation, messages)):
+                    ignorees += 1
+                    continue
+                futures.append(executor.submit(traiter_conversation, conversation, messages, full, instantane))
+
+            for future in as_completed(futures):
+                try:
+                    conversation_id, mise_a_jour = future.result()
+                except Exception as e:
+                    print(f"Erreur lors du traitement d'une conversation : {e}")
+                    echecs += 1
+                    continue
+                if mise_a_jour is None:
+                    print(f"Conversation {conversation_id} non analysée, elle sera retraitée à la prochaine exécution.")
+                    echecs += 1
+                    continue
+                mises_a_jour.append(mise_a_jour)
+                ids_en_attente.append(conversation_id)
+                traitees += 1
+
+                if len(mises_a_jour) >= SCORE_BATCH_SIZE:
+                    if enregistrer_scores(mises_a_jour):
+                        ajouter_checkpoint(ids_en_attente)
+                    mises_a_jour, ids_en_attente = [], []
+
+        if enregistrer_scores(mises_a_jour):
+            ajouter_checkpoint(ids_en_attente)
+        mises_a_jour = []
+
+        # Exécution complète : le fichier de reprise n'est plus utile
+        if os.path.exists(ENRICH_CHECKPOINT_PATH) and not echecs:
+            os.remove(ENRICH_CHECKPOINT_PATH)
 
     except Exception as e:
         print(f"Erreur lors du traitement des conversations : {e}")
+    finally:
+        if mises_a_jour and enregistrer_scores(mises_a_jour):
+            ajouter_checkpoint(ids_en_attente)
+        print(f"{traitees} conversation(s) traitée(s), {ignorees} ignorée(s), {echecs} en échec.")
+        statistiques.afficher()
+        if ENRICH_METRICS_PATH:
+            with open(ENRICH_METRICS_PATH, "w", encoding="utf-8") as f:
+                f.write(metrics.render())
@@ -0,0 +1,117 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Métriques de latence et d'erreurs, exposées au format texte Prometheus
+# Chaque appel externe est mesuré par un span nommé "service.opération" (ex. "airtable.get_conversation"),
+# étiqueté avec l'endpoint Flask en cours ("background" hors requête).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix="minotaure", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.histograms = {}  # (nom, étiquettes) -> Histogram
+        self.counters = {}  # (nom, étiquettes) -> valeur
+        self.gauges = {}  # nom -> fonction renvoyant {étiquettes: valeur}
+        self.help = {}
+        self.lock = threading.Lock()
+        self.endpoint_resolver = lambda: "background"
+        self.span_listener = None  # Appelée avec (stage, durée) pour chaque span (ex. journal des requêtes lentes)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Enregistrer une jauge calculée à la lecture (ex. statistiques d'un cache)
+    def gauge(self, name, func, help_text=""):
+        self.gauges[name] = func
+        self.help[name] = help_text
+
+    # Mesurer la durée d'une étape ; une exception est comptée comme erreur puis relancée
+    @contextmanager
+    def span(self, stage):
+        endpoint = self.endpoint_resolver()
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("stage_errors_total", stage=stage, endpoint=endpoint)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            self.observe("stage_duration_seconds", duration, stage=stage, endpoint=endpoint)
+            if self.span_listener:
+                self.span_listener(stage, duration)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        declared = set()
+        for (name, labels), histogram in histograms:
+            full_name = f"{self.prefix}_{name}"
+            if full_name not in declared:
+                lines.append(f"# TYPE {full_name} histogram")
+                declared.add(full_name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{full_name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{full_name}_sum{_labels(labels)} {histogram.sum:.6f}")
+            lines.append(f"{full_name}_count{_labels(labels)} {histogram.count}")
+
+        for (name, labels), value in counters:
+            full_name = f"{self.prefix}_{name}"
+            if full_name not in declared:
+                lines.append(f"# TYPE {full_name} counter")
+                declared.add(full_name)
+            lines.append(f"{full_name}{_labels(labels)} {value}")
+
+        for name, func in sorted(self.gauges.items()):
+            full_name = f"{self.prefix}_{name}"
+            if self.help.get(name):
+                lines.append(f"# HELP {full_name} {self.help[name]}")
+            lines.append(f"# TYPE {full_name} gauge")
+            for labels, value in sorted(func().items()):
+                lines.append(f"{full_name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+# Registre partagé par l'application, les files d'arrière-plan et l'enrichissement
+registry = Metrics()
@@ -0,0 +1,284 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import unicodedata
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Index BM25 local des documents de files/
+# Construction hors ligne : `python retrieval.py build` (incrémentale, seuls les fichiers modifiés sont relus)
+# Au démarrage de l'application, les matrices sont ouvertes en mémoire projetée (mmap).
+
+FILES_DIR = os.getenv("RETRIEVAL_FILES_DIR", "files")
+INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", "index")
+DOCUMENT_EXTENSIONS = (".pdf", ".txt", ".md")
+
+CHUNK_WORDS = 180  # Taille d'un passage en mots
+CHUNK_OVERLAP = 40  # Recouvrement entre passages consécutifs
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = set("""
+a au aux avec ce ces cette dans de des du elle elles en et eux il ils je la le les leur leurs lui ma mais me
+meme mes moi mon ne nos notre nous on ou par pas pour qu que qui sa se ses son sur ta te tes toi ton tu un une
+vos votre vous c d j l m n s t y est sont etait ete etre avoir ai as avons avez ont eu plus tout tous toute
+toutes comme si sans sous aussi bien fait faire
+""".split())
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+# Fonction pour découper un texte en termes normalisés (minuscules, sans accents ni mots vides)
+
+def tokenize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in TOKEN_RE.findall(text) if len(t) > 1 and t not in STOPWORDS and not t.isdigit()]
+
+# Fonction pour extraire le texte d'un document, page par page
+
+def extract_pages(path):
+    if path.lower().endswith(".pdf"):
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise RuntimeError("Le paquet pypdf est nécessaire pour indexer les PDF (pip install pypdf).")
+        reader = PdfReader(path)
+        return [page.extract_text() or "" for page in reader.pages]
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        return [f.read()]
+
+# Fonction pour découper les pages d'un document en passages qui se recouvrent
+
+def chunk_pages(pages):
+    chunks = []
+    step = CHUNK_WORDS - CHUNK_OVERLAP
+    for page_number, page in enumerate(pages, 1):
+        words = page.split()
+        for start in range(0, max(1, len(words) - CHUNK_OVERLAP), step):
+            text = " ".join(words[start:start + CHUNK_WORDS]).strip()
+            if len(text) > 40:
+                chunks.append({"page": page_number, "text": text})
+    return chunks
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Fonction pour analyser un document (ou réutiliser l'analyse en cache s'il n'a pas changé)
+
+def analyze_file(path, cache_dir, previous):
+    stat = os.stat(path)
+    if (previous and previous["mtime"] == stat.st_mtime and previous["size"] == stat.st_size
+            and os.path.exists(os.path.join(cache_dir, f"{previous['sha256']}.json"))):
+        return previous, False
+
+    digest = file_digest(path)
+    cache_path = os.path.join(cache_dir, f"{digest}.json")
+    if previous and previous["sha256"] == digest and os.path.exists(cache_path):
+        return dict(previous, mtime=stat.st_mtime, size=stat.st_size), False
+
+    if not os.path.exists(cache_path):
+        chunks = chunk_pages(extract_pages(path))
+        for chunk in chunks:
+            terms = {}
+            for term in tokenize(chunk["text"]):
+                terms[term] = terms.get(term, 0) + 1
+            chunk["terms"] = terms
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(chunks, f, ensure_ascii=False)
+    return {"sha256": digest, "mtime": stat.st_mtime, "size": stat.st_size}, True
+
+# Construction (incrémentale) de l'index : analyse des documents modifiés puis calcul des poids BM25
+
+def build_index(files_dir=FILES_DIR, index_dir=INDEX_DIR):
+    started = time.perf_counter()
+    cache_dir = os.path.join(index_dir, "files")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    manifest_path = os.path.join(index_dir, "manifest.json")
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {"files": {}}
+
+    paths = sorted(
+        os.path.join(files_dir, name) for name in os.listdir(files_dir)
+        if name.lower().endswith(DOCUMENT_EXTENSIONS) and name != "readme.txt"
+    )
+    files, changed = {}, 0
+    for path in paths:
+        info, updated = analyze_file(path, cache_dir, manifest["files"].get(path))
+        files[path] = info
+        changed += updated
+    removed = set(manifest["files"]) - set(files)
+
+    if not changed and not removed and os.path.exists(os.path.join(index_dir, "postings_weight.npy")):
+        logger.info("Index de recherche à jour, aucun document modifié.")
+        return manifest
+
+    # Rassembler les passages de tous les documents
+    chunks, term_counts = [], []
+    for path, info in files.items():
+        with open(os.path.join(cache_dir, f"{info['sha256']}.json"), encoding="utf-8") as f:
+            for chunk in json.load(f):
+                chunks.append({"source": os.path.basename(path), "page": chunk["page"], "text": chunk["text"]})
+                term_counts.append(chunk["terms"])
+
+    vocabulary = {}
+    for terms in term_counts:
+        for term in terms:
+            vocabulary.setdefault(term, len(vocabulary))
+
+    # Postings triés par terme (format CSC) : pour chaque terme, les passages et leur poids BM25
+    doc_lengths = np.array([sum(terms.values()) for terms in term_counts], dtype=np.float32)
+    avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 1.0
+    rows, cols, tfs = [], [], []
+    for doc, terms in enumerate(term_counts):
+        for term, tf in terms.items():
+            rows.append(vocabulary[term])
+            cols.append(doc)
+            tfs.append(tf)
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int32)
+    tfs = np.array(tfs, dtype=np.float32)
+
+    order = np.argsort(rows, kind="stable")
+    rows, cols, tfs = rows[order], cols[order], tfs[order]
+    df = np.bincount(rows, minlength=len(vocabulary)).astype(np.float32)
+    term_ptr = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+
+    n_docs = len(chunks)
+    idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths[cols] / avg_length)
+    weights = (idf[rows] * tfs * (BM25_K1 + 1) / (tfs + norm)).astype(np.float32)
+
+    np.save(os.path.join(index_dir, "term_ptr.npy"), term_ptr)
+    np.save(os.path.join(index_dir, "postings_doc.npy"), cols)
+    np.save(os.path.join(index_dir, "postings_weight.npy"), weights)
+    with open(os.path.join(index_dir, "vocabulary.json"), "w", encoding="utf-8") as f:
+        json.dump(vocabulary, f, ensure_ascii=False)
+    with open(os.path.join(index_dir, "chunks.json"), "w", encoding="utf-8") as f:
+        json.dump(chunks, f, ensure_ascii=False)
+
+    # Supprimer les analyses en cache des documents retirés ou modifiés
+    kept = {f"{info['sha256']}.json" for info in files.values()}
+    for name in os.listdir(cache_dir):
+        if name not in kept:
+            os.remove(os.path.join(cache_dir, name))
+
+    manifest = {"files": files, "chunks": n_docs, "terms": len(vocabulary), "built_at": time.time()}
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    logger.info(
+        f"Index de recherche construit en {time.perf_counter() - started:.1f}s : "
+        f"{n_docs} passages, {len(vocabulary)} termes, {changed} document(s) réanalysé(s), {len(removed)} retiré(s)."
+    )
+    return manifest
+
+
+# Recherche BM25 sur l'index projeté en mémoire
+
+class Retriever:
+    def __init__(self, index_dir=INDEX_DIR):
+        self.term_ptr = np.load(os.path.join(index_dir, "term_ptr.npy"), mmap_mode="r")
+        self.postings_doc = np.load(os.path.join(index_dir, "postings_doc.npy"), mmap_mode="r")
+        self.postings_weight = np.load(os.path.join(index_dir, "postings_weight.npy"), mmap_mode="r")
+        with open(os.path.join(index_dir, "vocabulary.json"), encoding="utf-8") as f:
+            self.vocabulary = json.load(f)
+        with open(os.path.join(index_dir, "chunks.json"), encoding="utf-8") as f:
+            self.chunks = json.load(f)
+
+    def search(self, query, k=3):
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        matched = False
+        for term in set(tokenize(query)):
+            index = self.vocabulary.get(term)
+            if index is None:
+                continue
+            start, end = self.term_ptr[index], self.term_ptr[index + 1]
+            scores[self.postings_doc[start:end]] += self.postings_weight[start:end]
+            matched = True
+        if not matched:
+            return []
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            dict(self.chunks[doc], score=round(float(scores[doc]), 3))
+            for doc in top if scores[doc] > 0
+        ]
+
+# Fonction pour ouvrir l'index s'il existe (None sinon)
+
+def load_retriever(index_dir=INDEX_DIR):
+    if not os.path.exists(os.path.join(index_dir, "postings_weight.npy")):
+        logger.warning(f"Index de recherche absent ({index_dir}) : lancer `python retrieval.py build`.")
+        return None
+    try:
+        return Retriever(index_dir)
+    except Exception as e:
+        logger.error(f"Erreur lors du chargement de l'index de recherche : {e}")
+        return None
+
+# Mesure de la latence des requêtes sur l'index (requêtes tirées des passages indexés)
+
+def benchmark(retriever, queries=500, k=3, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = []
+    for doc in rng.integers(0, len(retriever.chunks), size=queries):
+        words = retriever.chunks[doc]["text"].split()
+        start = int(rng.integers(0, max(1, len(words) - 8)))
+        samples.append(" ".join(words[start:start + 8]))
+
+    latencies = []
+    for query in samples:
+        started = time.perf_counter()
+        retriever.search(query, k)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"{queries} requêtes, top-{k} sur {len(retriever.chunks)} passages : "
+          f"p50 {p50:.3f} ms, p95 {p95:.3f} ms, p99 {p99:.3f} ms, max {max(latencies):.3f} ms")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Index de recherche local sur les documents de files/")
+    parser.add_argument("--files", default=FILES_DIR, help="Répertoire des documents")
+    parser.add_argument("--index", default=INDEX_DIR, help="Répertoire de l'index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", help="Construire ou mettre à jour l'index")
+    query_parser = commands.add_parser("query", help="Rechercher des passages")
+    query_parser.add_argument("text")
+    query_parser.add_argument("-k", type=int, default=3)
+    bench_parser = commands.add_parser("bench", help="Mesurer la latence des requêtes")
+    bench_parser.add_argument("--queries", type=int, default=500)
+    bench_parser.add_argument("-k", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_index(args.files, args.index)
+        sys.exit(0)
+
+    retriever = load_retriever(args.index)
+    if retriever is None:
+        sys.exit(1)
+    if args.command == "query":
+        for passage in retriever.search(args.text, args.k):
+            print(f"[{passage['score']}] {passage['source']} p.{passage['page']} : {passage['text'][:200]}")
+    else:
+        benchmark(retriever, args.queries, args.k)
@@ -0,0 +1,133 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+SLACK_POST_MESSAGE_URL = "https://slack.com/api/chat.postMessage"
+
+
+# Envoi des messages Slack en arrière-plan
+# Un seul thread consomme la file dans l'ordre d'arrivée : l'ordre des messages d'un même fil est conservé.
+# Les connexions HTTP sont réutilisées (keep-alive) et les réponses 429 respectent l'en-tête Retry-After.
+# Un message peut viser un fil dont le thread_ts n'est pas encore connu via thread_key :
+# le thread_ts est résolu au moment de l'envoi, une fois le message de départ posté.
+# Seul le message de départ (celui qui porte on_posted) définit le fil : si son envoi échoue, les
+# messages suivants sont postés hors fil sans devenir la racine de la conversation.
+
+class SlackDispatcher:
+    def __init__(self, tokens, url=SLACK_POST_MESSAGE_URL, timeout=10, max_retries=3, pool_size=4, thread_keys_size=10000):
+        self.tokens = tokens  # {"bot": ..., "manual": ...}
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.thread_keys_size = thread_keys_size
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self.session.mount("http://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self.thread_keys = OrderedDict()  # Clé de fil (ex. ConversationID) -> thread_ts Slack
+        self.thread_keys_lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="slack-dispatcher", daemon=True)
+        self.thread.start()
+
+    # Mettre un message en file ; on_posted(ts) est appelé après un envoi réussi
+
+    def post(self, text, channel, thread_ts=None, thread_key=None, manual=False, on_posted=None):
+        self.queue.put((text, channel, thread_ts, thread_key, manual, on_posted))
+
+    # Associer une clé de fil à un thread_ts Slack déjà connu
+
+    def remember_thread(self, thread_key, thread_ts):
+        with self.thread_keys_lock:
+            self.thread_keys[thread_key] = thread_ts
+            self.thread_keys.move_to_end(thread_key)
+            while len(self.thread_keys) > self.thread_keys_size:
+                self.thread_keys.popitem(last=False)
+
+    def thread_ts_for(self, thread_key):
+        with self.thread_keys_lock:
+            return self.thread_keys.get(thread_key)
+
+    # Attendre l'envoi de tous les messages en file
+
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout=10):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.flush(timeout)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+
+            text, channel, thread_ts, thread_key, manual, on_posted = item
+            try:
+                if not thread_ts and thread_key:
+                    thread_ts = self.thread_ts_for(thread_key)
+                ts = self._send(text, channel, thread_ts, manual)
+                if ts and thread_key and not thread_ts and on_posted:
+                    self.remember_thread(thread_key, ts)
+                if ts and on_posted:
+                    on_posted(ts)
+            except Exception as e:
+                logger.error(f"Erreur dans la file d'envoi Slack : {e}")
+
+    def _send(self, text, channel, thread_ts, manual):
+        token = self.tokens.get("manual" if manual else "bot")
+        if not token:
+            logger.error("Token Slack non défini.")
+            return None
+
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        }
+        data = {
+            "channel": channel,
+            "text": text
+        }
+        if thread_ts:
+            data["thread_ts"] = thread_ts
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.span("slack.post_message"):
+                    response = self.session.post(self.url, headers=headers, json=data, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.error(f"Erreur lors de l'envoi du message Slack : {e}")
+                if attempt < self.max_retries:
+                    time.sleep(2 ** attempt)
+                    continue
+                return None
+
+            if response.status_code == 429 and attempt < self.max_retries:
+                retry_after = int(response.headers.get("Retry-After", "1"))
+                logger.warning(f"Limite Slack atteinte, nouvel essai dans {retry_after}s.")
+                time.sleep(retry_after)
+                continue
+
+            if response.status_code == 200 and response.json().get("ok"):
+                logger.info(f"Message Slack envoyé ({len(text)} caractères).")
+                return response.json().get("ts")
+
+            logger.error(f"Erreur lors de l'envoi du message Slack : {response.text}")
+            metrics.inc("stage_errors_total", stage="slack.post_message", endpoint="background")
+            return None
+        return None
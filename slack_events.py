@@ -0,0 +1,80 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Traitement des événements Slack en arrière-plan
+# L'endpoint répond à Slack dès la signature vérifiée (délai de 3 s) ; un seul thread traite
+# ensuite les événements dans l'ordre d'arrivée. Slack renvoie un événement non acquitté à temps
+# (en-tête X-Slack-Retry-Num) : les event_id déjà reçus sont ignorés pendant seen_ttl secondes.
+
+class SlackEventQueue:
+    def __init__(self, handler, seen_size=10000, seen_ttl=3600):
+        self.handler = handler
+        self.seen_size = seen_size
+        self.seen_ttl = seen_ttl
+        self.seen = OrderedDict()  # event_id -> instant de réception
+        self.seen_lock = threading.Lock()
+        self.duplicates = 0
+        self.queue = queue.Queue()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="slack-events", daemon=True)
+        self.thread.start()
+
+    # Marquer un event_id comme reçu ; renvoie False s'il l'a déjà été
+    def _first_delivery(self, event_id):
+        now = time.monotonic()
+        with self.seen_lock:
+            while self.seen:
+                received_at = next(iter(self.seen.values()))
+                if now - received_at < self.seen_ttl and len(self.seen) < self.seen_size:
+                    break
+                self.seen.popitem(last=False)
+            if event_id in self.seen:
+                self.duplicates += 1
+                return False
+            self.seen[event_id] = now
+            return True
+
+    # Mettre un événement en file ; renvoie False s'il s'agit d'un doublon
+    def submit(self, data, retry_num=None):
+        event_id = data.get("event_id")
+        if event_id and not self._first_delivery(event_id):
+            logger.info(f"Événement Slack {event_id} déjà reçu (nouvel essai {retry_num}), ignoré.")
+            metrics.inc("slack_events_duplicates_total")
+            return False
+        self.queue.put(data)
+        return True
+
+    # Attendre le traitement de tous les événements en file
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout=10):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.flush(timeout)
+
+    def pending_count(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            try:
+                with metrics.span("slack.handle_event"):
+                    self.handler(item)
+            except Exception as e:
+                logger.error(f"Erreur lors du traitement de l'événement Slack {item.get('event_id')} : {e}")
@@ -0,0 +1,265 @@
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+# Stockage des conversations et des messages
+# Les enregistrements ont la forme Airtable ({"id": ..., "fields": {...}}) quel que soit le stockage :
+# - AirtableStorage : lectures par l'API Airtable, écritures par la file d'écriture différée ;
+# - SQLiteStorage : base locale (WAL) pour le chemin des requêtes, recopiée en arrière-plan dans Airtable,
+#   qui reste l'outil de suivi de l'équipe. Une conversation absente de la base locale (redémarrage du dyno)
+#   est importée d'Airtable avec ses messages au premier accès.
+
+
+class AirtableStorage:
+    def __init__(self, conversations, messages, context, writer):
+        self.conversations = conversations
+        self.messages = messages
+        self.context = context
+        self.writer = writer
+
+    def get_conversation(self, conversation_id):
+        with metrics.span("airtable.get_conversation"):
+            records = self.conversations.all(formula=f"{{ConversationID}} = '{conversation_id}'")
+        return records[0] if records else None
+
+    def get_conversation_by_thread_ts(self, thread_ts):
+        with metrics.span("airtable.get_conversation_by_thread_ts"):
+            records = self.conversations.all(formula=f"{{SlackThreadTS}} = '{thread_ts}'")
+        return records[0] if records else None
+
+    def create_conversation(self, fields):
+        with metrics.span("airtable.create_conversation"):
+            return self.conversations.create(fields)
+
+    def update_conversation(self, record_id, fields):
+        self.writer.update(self.conversations, record_id, fields)
+
+    # Le MessageID sert de clé locale : le message est utilisable avant son envoi à Airtable
+    def add_message(self, conversation_id, fields):
+        self.writer.create(self.messages, fields, key=fields["MessageID"])
+
+    def list_messages(self, conversation_id):
+        with metrics.span("airtable.load_history"):
+            return self.messages.all(formula=f"{{ConversationID}} = '{conversation_id}'", sort=["Timestamp"])
+
+    def unread_messages(self, conversation_id):
+        formula = f"AND({{ConversationID}} = '{conversation_id}', NOT({{Displayed}}))"
+        with metrics.span("airtable.unread_messages"):
+            return self.messages.all(formula=formula, sort=["Timestamp"])
+
+    def find_message(self, message_id):
+        with metrics.span("airtable.find_message"):
+            records = self.messages.all(formula=f"{{MessageID}} = '{message_id}'", max_records=1)
+        return records[0] if records else None
+
+    # Marquer des messages comme affichés (Record ID Airtable ou MessageID), en écritures groupées
+    # sync=True écrit tout de suite les messages déjà présents dans Airtable (batch_update), pour
+    # qu'une relecture immédiate des messages non lus ne les renvoie pas ; les autres passent par la file
+    def mark_displayed(self, refs, sync=False):
+        refs = list(refs)
+        if sync and refs:
+            record_ids = [self.writer.resolve(ref) or ref for ref in refs]
+            known = [record_id for record_id in record_ids if record_id.startswith("rec")]
+            try:
+                with metrics.span("airtable.mark_displayed"):
+                    self.messages.batch_update([{"id": record_id, "fields": {"Displayed": True}} for record_id in known])
+                refs = [ref for ref, record_id in zip(refs, record_ids) if record_id not in known]
+            except Exception as e:
+                logger.error(f"Erreur lors du marquage immédiat des messages affichés, envoi différé : {e}")
+        for ref in refs:
+            self.writer.update(self.messages, ref, {"Displayed": True}, key_field="MessageID")
+
+    def load_context(self):
+        with metrics.span("airtable.load_context"):
+            return self.context.all(max_records=1, sort=["Timestamp"])
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation_id TEXT PRIMARY KEY,
+    record_id TEXT NOT NULL UNIQUE,
+    slack_thread_ts TEXT,
+    fields TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversations_slack_thread_ts ON conversations (slack_thread_ts);
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY,
+    record_id TEXT,
+    conversation_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    displayed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_unread ON messages (conversation_id, displayed, timestamp);
+CREATE INDEX IF NOT EXISTS messages_history ON messages (conversation_id, timestamp);
+CREATE INDEX IF NOT EXISTS messages_record_id ON messages (record_id);
+"""
+
+
+class SQLiteStorage:
+    def __init__(self, path, remote=None):
+        self.path = path
+        self.remote = remote  # AirtableStorage : recopie des écritures et import des conversations inconnues
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()  # Une seule connexion partagée : les requêtes durent quelques microsecondes
+        self.import_lock = threading.Lock()
+
+    def _execute(self, stage, sql, params=()):
+        with metrics.span(f"sqlite.{stage}"), self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def _executemany(self, stage, sql, rows):
+        with metrics.span(f"sqlite.{stage}"), self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(sql, rows)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _conversation(self, row):
+        return {"id": row["record_id"], "fields": json.loads(row["fields"])}
+
+    def _message(self, row):
+        return {
+            "id": row["record_id"] or row["message_id"],
+            "fields": {
+                "MessageID": row["message_id"],
+                "Role": row["role"],
+                "Content": row["content"],
+                "Timestamp": row["timestamp"],
+                "Displayed": bool(row["displayed"])
+            }
+        }
+
+    def _store_conversation(self, record):
+        fields = record["fields"]
+        self._execute(
+            "store_conversation",
+            "INSERT OR REPLACE INTO conversations (conversation_id, record_id, slack_thread_ts, fields) VALUES (?, ?, ?, ?)",
+            (fields["ConversationID"], record["id"], fields.get("SlackThreadTS"), json.dumps(fields))
+        )
+
+    # Importer une conversation d'Airtable et ses messages dans la base locale
+    def _import(self, record):
+        if record is None:
+            return None
+        conversation_id = record["fields"].get("ConversationID")
+        with self.import_lock:
+            existing = self._execute("get_conversation", "SELECT * FROM conversations WHERE conversation_id = ?", (conversation_id,))
+            if existing:
+                return self._conversation(existing[0])
+            messages = self.remote.list_messages(conversation_id)
+            self._executemany(
+                "import_messages",
+                "INSERT OR IGNORE INTO messages (message_id, record_id, conversation_id, role, content, timestamp, displayed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        m["fields"].get("MessageID") or m["id"], m["id"], conversation_id, m["fields"].get("Role", ""),
+                        m["fields"].get("Content", ""), m["fields"].get("Timestamp", ""), int(bool(m["fields"].get("Displayed")))
+                    )
+                    for m in messages
+                ]
+            )
+            self._store_conversation(record)
+        logger.info(f"Conversation {conversation_id} importée d'Airtable ({len(messages)} messages).")
+        return record
+
+    def _ensure_conversation(self, conversation_id):
+        if self.remote and not self._execute("has_conversation", "SELECT 1 FROM conversations WHERE conversation_id = ?", (conversation_id,)):
+            self._import(self.remote.get_conversation(conversation_id))
+
+    def get_conversation(self, conversation_id):
+        rows = self._execute("get_conversation", "SELECT * FROM conversations WHERE conversation_id = ?", (conversation_id,))
+        if rows:
+            return self._conversation(rows[0])
+        return self._import(self.remote.get_conversation(conversation_id)) if self.remote else None
+
+    def get_conversation_by_thread_ts(self, thread_ts):
+        rows = self._execute("get_conversation_by_thread_ts", "SELECT * FROM conversations WHERE slack_thread_ts = ?", (thread_ts,))
+        if rows:
+            return self._conversation(rows[0])
+        return self._import(self.remote.get_conversation_by_thread_ts(thread_ts)) if self.remote else None
+
+    # La création reste synchrone côté Airtable : le Record ID sert de lien aux messages de la conversation
+    def create_conversation(self, fields):
+        record = self.remote.create_conversation(fields) if self.remote else {"id": f"loc{uuid.uuid4().hex}", "fields": dict(fields)}
+        self._store_conversation(record)
+        return record
+
+    def update_conversation(self, record_id, fields):
+        with metrics.span("sqlite.update_conversation"), self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT fields FROM conversations WHERE record_id = ?", (record_id,)).fetchone()
+                if row is not None:
+                    merged = dict(json.loads(row["fields"]), **fields)
+                    self.db.execute(
+                        "UPDATE conversations SET fields = ?, slack_thread_ts = ? WHERE record_id = ?",
+                        (json.dumps(merged), merged.get("SlackThreadTS"), record_id)
+                    )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        if self.remote:
+            self.remote.update_conversation(record_id, fields)
+
+    def add_message(self, conversation_id, fields):
+        self._execute(
+            "add_message",
+            "INSERT INTO messages (message_id, conversation_id, role, content, timestamp, displayed) VALUES (?, ?, ?, ?, ?, ?)",
+            (fields["MessageID"], conversation_id, fields["Role"], fields["Content"], fields["Timestamp"], int(fields.get("Displayed", False)))
+        )
+        if self.remote:
+            self.remote.add_message(conversation_id, fields)
+
+    def list_messages(self, conversation_id):
+        self._ensure_conversation(conversation_id)
+        rows = self._execute("load_history", "SELECT * FROM messages WHERE conversation_id = ? ORDER BY timestamp", (conversation_id,))
+        return [self._message(row) for row in rows]
+
+    def unread_messages(self, conversation_id):
+        self._ensure_conversation(conversation_id)
+        rows = self._execute(
+            "unread_messages",
+            "SELECT * FROM messages WHERE conversation_id = ? AND displayed = 0 ORDER BY timestamp",
+            (conversation_id,)
+        )
+        return [self._message(row) for row in rows]
+
+    def find_message(self, message_id):
+        rows = self._execute("find_message", "SELECT * FROM messages WHERE message_id = ? OR record_id = ?", (message_id, message_id))
+        if rows:
+            return self._message(rows[0])
+        return self.remote.find_message(message_id) if self.remote else None
+
+    # La base locale est à jour immédiatement : la recopie dans Airtable reste différée
+    def mark_displayed(self, refs, sync=False):
+        refs = list(refs)
+        if not refs:
+            return
+        self._executemany(
+            "mark_displayed",
+            "UPDATE messages SET displayed = 1 WHERE message_id = ? OR record_id = ?",
+            [(ref, ref) for ref in refs]
+        )
+        if self.remote:
+            self.remote.mark_displayed(refs)
+
+    # Le contexte initial est déjà gardé en cache par l'application : il est lu dans Airtable
+    def load_context(self):
+        return self.remote.load_context() if self.remote else []